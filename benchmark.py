@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import argparse
+import json
+import os
+import os.path as op
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from smeargle import png
+from smeargle.backend import backends
+from smeargle.cache import LineCache
+from smeargle.font import Font, compiled_filename
+from smeargle.formats import formats
+from smeargle.script import Script
+
+RESULTS_VERSION = 1
+
+# Printable ASCII, which every synthetic font covers.
+CHARACTERS = [chr(c) for c in range(32, 127)]
+
+# Synthetic fonts: name -> (bits per pixel, glyph width, glyph height).
+SYNTHETIC_FONTS = {
+    'synth2': (2, 8, 8),
+    'synth4': (4, 8, 16),
+}
+
+# Columns of a tile which some porygon formats refuse to encode pixels in.
+BLANK_COLUMNS = {
+    'linear1': slice(0, 1),
+    'planar2': slice(4, None),
+    'planar4': slice(2, None),
+}
+
+
+def make_font(directory, name, bpp, width, height, seed=0):
+    """Writes a font of random glyphs covering CHARACTERS, and returns the
+    filename of its JSON."""
+    rng = np.random.RandomState(seed)
+    colors = 2 ** bpp
+    glyphs = np.zeros((len(CHARACTERS), height, width), dtype=np.uint8)
+    table = {}
+
+    for i, char in enumerate(CHARACTERS):
+        advance = 4 if char == ' ' else int(rng.randint(3, width + 1))
+        if char != ' ':
+            ink = rng.randint(1, colors, (height, advance - 1))
+            glyphs[i, :, :advance - 1] = ink * (rng.random_sample((height, advance - 1)) < 0.4)
+        table[char] = {'index': i + 1, 'width': advance}
+
+    # Glyphs are laid out 16 to a row, as Font expects.
+    rows = -(-len(glyphs) // 16)
+    sheet = np.zeros((rows * 16, height, width), dtype=np.uint8)
+    sheet[:len(glyphs)] = glyphs
+    sheet = sheet.reshape(rows, 16, height, width).swapaxes(1, 2).reshape(rows * height, 16 * width)
+    palette = [tuple(int(v) for v in rng.randint(0, 256, 3)) for i in range(colors)]
+
+    image = op.join(directory, name + '.png')
+    png.write(image, sheet, palette)
+
+    filename = op.join(directory, name + '.json')
+    with open(filename, mode='w') as f:
+        json.dump({
+            'font_name': name,
+            'filename': image,
+            'bits_per_pixel': bpp,
+            'width': width,
+            'height': height,
+            'palette': ['{:02x}{:02x}{:02x}'.format(*color) for color in palette],
+            'map': table,
+        }, f)
+
+    return filename
+
+
+def copy_font(directory, filename):
+    """Copies a font's JSON so that its image is found from any directory, and
+    its compiled form is written alongside the copy."""
+    with open(filename, mode='rb') as f:
+        data = json.load(f)
+    data['filename'] = op.abspath(op.join(op.dirname(filename), data['filename']))
+
+    copy = op.join(directory, op.basename(filename))
+    with open(copy, mode='w') as f:
+        json.dump(data, f)
+
+    return copy
+
+
+def make_script(filename, characters, lines, repetition, words, seed=0):
+    """Writes a script of random words built from characters.
+
+    Each line repeats an earlier line with probability repetition, and is
+    otherwise new, with a number of words drawn from the range words.
+    """
+    rng = random.Random(seed)
+    letters = [c for c in characters if len(c) == 1 and c != ' ']
+    vocabulary = [''.join(rng.choice(letters) for i in range(rng.randint(1, 10))) for j in range(4096)]
+    unique = []
+
+    with open(filename, mode='w', encoding='UTF-8') as f:
+        for i in range(lines):
+            if unique and rng.random() < repetition:
+                line = rng.choice(unique)
+            else:
+                line = ' '.join(rng.choice(vocabulary) for j in range(rng.randint(*words)))
+                unique.append(line)
+            f.write(line + '\n')
+
+    return filename
+
+
+class Bench:
+    """Runs benchmark cases, timing each and optionally measuring its peak
+    memory in a second, traced run."""
+
+    def __init__(self, repeat=1, memory=True):
+        self.repeat = repeat
+        self.memory = memory
+        self.results = {}
+
+    def run(self, case, count, unit, setup, work, **params):
+        """Times work(setup()) and records count units processed per second.
+
+        setup runs outside the timing, and whatever work returns is ignored."""
+        best = None
+        for i in range(self.repeat):
+            state = setup()
+            start = time.perf_counter()
+            work(state)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+
+        record = dict(params, seconds=best, count=count, unit=unit, rate=count / best if best else None)
+
+        if self.memory:
+            state = setup()
+            tracemalloc.start()
+            try:
+                work(state)
+                record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        self.results[case] = record
+        print('{:<48} {:>14,.0f} {}/s{}'.format(
+            case, record['rate'] or 0, unit,
+            '  peak {:.1f} MiB'.format(record['peak_bytes'] / 2**20) if self.memory else ''
+        ))
+
+        return record
+
+
+def bench_font(bench, name, filename, backend):
+    count = max(entry['index'] for entry in Font(filename, backend, compiled=False).table.values())
+
+    # Each setup returns the compiled argument for Font.
+    def json_only():
+        return False
+
+    def uncompiled():
+        if op.exists(compiled_filename(filename)):
+            os.remove(compiled_filename(filename))
+        return True
+
+    def compiled():
+        Font(filename, backend)
+        return True
+
+    # Every glyph is sliced out, or read back, once.
+    def load(state):
+        font = Font(filename, backend, compiled=state)
+        for idx in range(count):
+            font.pixels(idx)
+
+    bench.run('font_load/{}/json'.format(name), count, 'glyphs', json_only, load, font=name, stage='font_load')
+    bench.run('font_load/{}/compile'.format(name), count, 'glyphs', uncompiled, load, font=name, stage='font_load')
+    bench.run('font_load/{}/compiled'.format(name), count, 'glyphs', compiled, load, font=name, stage='font_load')
+
+
+def bench_script(bench, directory, name, font_file, backend, lines, repetition, words, compositor):
+    params = {'font': name, 'lines': lines, 'repetition': repetition}
+    tag = '{}/{}/{}'.format(name, lines, repetition)
+    font = Font(font_file, backend)
+    if compositor == 'bitmask' and len(font.palette) > 4:
+        print('{:<48} skipped: {} colors is too many for bitmask'.format('render_lines/' + tag, len(font.palette)))
+        return
+    filename = make_script(op.join(directory, 'script.txt'), font.table.keys(), lines, repetition, words)
+    script = Script(filename, compositor=compositor)
+    rendered = None
+
+    def render(state):
+        nonlocal rendered
+        rendered = script.render_lines(font, cache=LineCache())
+    bench.run('render_lines/' + tag, lines, 'lines', lambda: None, render, stage='render_lines', **params)
+
+    tilemap = None
+    tiles = sum(len(line[4]) for line in rendered)
+
+    def generate(state):
+        nonlocal tilemap
+        tilemap = script.generate_tilemap(font, rendered)
+    bench.run('generate_tilemap/' + tag, tiles, 'tiles', lambda: None, generate, stage='generate_tilemap', **params)
+
+    (store, ids) = tilemap[:2]
+    output = op.join(directory, 'out.png')
+
+    def write_compressed(state):
+        script.render_tiles_to_file(font, store, output)
+    bench.run('write_compressed/' + tag, len(store), 'tiles', lambda: None, write_compressed,
+              stage='render_tiles_to_file', **params)
+
+    def write_raw(state):
+        script.render_tiles_to_file(font, store, output, ids=ids)
+    bench.run('write_raw/' + tag, len(ids), 'tiles', lambda: None, write_raw,
+              stage='render_tiles_to_file', **params)
+
+
+def bench_formats(bench, count, seed=0):
+    rng = np.random.RandomState(seed)
+    done = set()
+
+    for fmt, encoder in formats.items():
+        if encoder in done:
+            continue
+        done.add(encoder)
+
+        tiles = rng.randint(0, 2 ** int(fmt[-1]), (count, 8, 8)).astype(np.uint8)
+        if fmt in BLANK_COLUMNS:
+            tiles[:, :, BLANK_COLUMNS[fmt]] = 0
+        def work(state, encoder=encoder):
+            encoder(state, None)
+        bench.run('encode/{}'.format(fmt), count, 'tiles', lambda: tiles, work, format=fmt, stage='encode')
+
+
+def compare(results, baseline, threshold):
+    """Prints each case's change in throughput and memory against a baseline,
+    and returns the cases slower than it by more than threshold percent."""
+    regressions = []
+    print()
+    print('{:<48} {:>14} {:>14} {:>8} {:>8}'.format('case', 'baseline', 'current', 'rate', 'memory'))
+
+    for case, record in results['results'].items():
+        old = baseline['results'].get(case)
+        if old is None or not old.get('rate') or not record.get('rate'):
+            print('{:<48} {:>14} {:>14,.0f}'.format(case, '-', record['rate'] or 0))
+            continue
+
+        change = record['rate'] / old['rate'] - 1
+        memory = ''
+        if old.get('peak_bytes') and record.get('peak_bytes'):
+            memory = '{:+.1%}'.format(record['peak_bytes'] / old['peak_bytes'] - 1)
+        flag = ''
+        if change < -threshold / 100:
+            regressions.append(case)
+            flag = '  REGRESSION'
+        print('{:<48} {:>14,.0f} {:>14,.0f} {:>+8.1%} {:>8}{}'.format(
+            case, old['rate'], record['rate'], change, memory, flag
+        ))
+
+    for key in ('backend', 'python', 'numpy', 'machine'):
+        if baseline['meta'].get(key) != results['meta'].get(key):
+            print('WARNING: baseline {} was {}, not {}.'.format(key, baseline['meta'].get(key),
+                                                                results['meta'].get(key)))
+
+    return regressions
+
+
+def _list(kind):
+    return lambda text: [kind(item) for item in text.split(',')]
+
+
+def _range(text):
+    (low, high) = (int(v) for v in text.split('-'))
+    return (low, high)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks Smeargle against synthetic scripts and fonts.',
+        epilog='Please see the included readme.txt for documentation.'
+    )
+    parser.add_argument('--backend', choices=backends.keys(), default='qt',
+                        help='rendering backend (default: qt)')
+    parser.add_argument('--fonts', type=_list(str), default=['melissa8'] + list(SYNTHETIC_FONTS),
+                        help='comma-separated fonts to use: melissa8, {} (default: all)'.format(
+                            ', '.join(SYNTHETIC_FONTS)))
+    parser.add_argument('--lines', type=_list(int), default=[10000],
+                        help='comma-separated script sizes in lines (default: 10000)')
+    parser.add_argument('--repetition', type=_list(float), default=[0.5],
+                        help='comma-separated fractions of lines which repeat an earlier line (default: 0.5)')
+    parser.add_argument('--words', type=_range, default=(2, 8), metavar='MIN-MAX',
+                        help='range of words per line (default: 2-8)')
+    parser.add_argument('--compositor', choices=['painter', 'bitmask'], default='painter',
+                        help='compositor for render_lines (default: painter)')
+    parser.add_argument('--tiles', type=int, default=65536,
+                        help='number of tiles for each porygon format encoder (default: 65536)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='time each case this many times and keep the best (default: 1)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the second, traced run of each case which measures peak memory')
+    parser.add_argument('--output', default='benchmark.json', metavar='FILE',
+                        help='results file (default: benchmark.json)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='results file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=10, metavar='PERCENT',
+                        help='slowdown against the baseline reported as a regression (default: 10)')
+    args = parser.parse_args()
+
+    for name in args.fonts:
+        if name != 'melissa8' and name not in SYNTHETIC_FONTS:
+            parser.error('unknown font {}'.format(name))
+
+    bench = Bench(repeat=args.repeat, memory=not args.no_memory)
+
+    with tempfile.TemporaryDirectory(prefix='smeargle-bench-') as directory:
+        fonts = {}
+        for name in args.fonts:
+            if name == 'melissa8':
+                fonts[name] = copy_font(directory, op.join(op.dirname(op.abspath(__file__)), 'melissa8.json'))
+            else:
+                fonts[name] = make_font(directory, name, *SYNTHETIC_FONTS[name])
+
+        for name, filename in fonts.items():
+            bench_font(bench, name, filename, args.backend)
+
+        for name, filename in fonts.items():
+            for lines in args.lines:
+                for repetition in args.repetition:
+                    bench_script(bench, directory, name, filename, args.backend, lines, repetition, args.words,
+                                 args.compositor)
+
+        bench_formats(bench, args.tiles)
+
+    results = {
+        'version': RESULTS_VERSION,
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'backend': args.backend,
+            'compositor': args.compositor,
+            'words': list(args.words),
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+        },
+        'results': bench.results,
+    }
+    with open(args.output, mode='w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+    print('Results written to {}.'.format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline, mode='rb') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{} case(s) regressed by more than {}%.'.format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
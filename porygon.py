@@ -13,274 +13,163 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
 # IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-import sys
+import argparse
+import glob
+import multiprocessing
+import os
 import os.path as op
+import time
 
-from PyQt5.QtGui import QImage, QPixmap, QPainter, QGuiApplication
+from smeargle.backend import backends, get_backend
+from smeargle.formats import encode, formats
 
 
-def linear1(tile, *args):
-    data = bytearray()
+def convert(image, fmt, backend='qt', output=True, stream=False):
+    """Converts one image to the given format.
 
-    for y in range(8):
-        byte = 0
-
-        for x in range(8):
-            if tile.pixelIndex(x, y) > 0:
-                byte += 2**(8 - x)
-
-        data.append(byte)
-
-    return bytes(data)
+    Writes output/<image>.bin and returns its filename and the number of
+    tiles converted. With stream, the image is decoded and converted one
+    8-pixel band at a time with the built-in PNG decoder, whatever the
+    backend, so memory use does not grow with the height of the image.
+    """
+    (image_base, ext) = op.splitext(image)
+    filename = '{}.bin'.format(image_base)
+    mapper = image_base + '.txt'
 
+    if not filename.startswith('output/'):
+        filename = 'output/{}'.format(filename)
+    os.makedirs(op.dirname(filename), exist_ok=True)
 
-def linear2(tile, palette):
-    data = bytearray()
+    bpp = int(fmt[-1])
 
-    for y in range(8):
-        bp1 = 0
-        bp2 = 0
+    if output: print('Loading image...')
+    if stream:
+        bands = get_backend('array').load_bands(image, 8)
+    else:
+        bands = [get_backend(backend).load_indexed(image)]
 
-        for x in range(8):
-            pixel = tile.pixelIndex(x, y)
-            if palette is not None:
-                pixel = palette[pixel]
+    palette = {}
+    if op.exists(mapper):
+        if output: print('Palette found. Loading...')
+        with open(mapper, mode='r') as f:
+            text = f.read().split('\n')
 
-            a = pixel & 0x1
-            b = pixel & 0x2
-            if a:
-                bp1 += 2**(7 - x)
-            if b:
-                bp2 += 2**(7 - x)
+        for line in text:
+            if line == '':
+                continue
+            a = line.split('=')
 
-        data.extend((bp1, bp2))
+            key = int(a[0])
+            value = int(a[1])
+            palette[key] = value
+    else:
+        if output: print('No palette found.')
+        palette = None
 
-    return bytes(data)
+    if output: print('Converting to {}'.format(fmt))
+    tiles = 0
+    with open(filename, mode='wb') as f:
+        for data, colors in bands:
+            if colors > 2**bpp:
+                raise ValueError('image has too many colors')
 
+            tiles += int(data.shape[0] / 8) * int(data.shape[1] / 8)
+            f.write(encode(data, fmt, palette))
 
-def planar2(tile, palette):
-    data = bytearray()
+    return filename, tiles
 
-    for y in range(8):
-        byte = 0
 
-        for x in range(4):
-            pixel = tile.pixelIndex(x, y)
-            if palette is not None:
-                pixel = palette[pixel]
-            pixel &= 0x3
-            byte = byte + (pixel << x * 2)
+def read_manifest(filename):
+    """Reads a manifest of 'image format' lines; images may be glob patterns."""
+    jobs = []
 
-        data.append(byte)
-        byte = 0
+    with open(filename, mode='r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
 
-        for x in range(4, 8):
-            pixel = tile.pixelIndex(x, y)
-            pixel &= 0x3
-            byte = byte + (pixel << x * 2)
+            (pattern, fmt) = line.rsplit(None, 1)
+            if fmt not in formats:
+                raise ValueError('unknown format {} in {}'.format(fmt, filename))
 
-        data.append(byte)
+            images = sorted(glob.glob(pattern)) or [pattern]
+            jobs.extend((image, fmt) for image in images)
 
-    return bytes(data)
+    return jobs
 
 
-def linear4(tile, palette):
-    data = bytearray()
+_backend = None
+_stream = False
 
-    for y in range(8):
-        bp1 = 0
-        bp2 = 0
 
-        for x in range(8):
-            pixel = tile.pixelIndex(x, y)
-            if palette is not None:
-                pixel = palette[pixel]
+def _init(backend, stream=False):
+    global _backend, _stream
+    (_backend, _stream) = (backend, stream)
+    get_backend('array' if stream else backend)
 
-            a = pixel & 0x1
-            b = pixel & 0x2
 
-            if a:
-                bp1 += 2**(7 - x)
-            if b:
-                bp2 += 2**(7 - x)
+def _convert(job):
+    (image, fmt) = job
+    start = time.perf_counter()
+    (filename, tiles) = convert(image, fmt, _backend, output=False, stream=_stream)
 
-        data.extend((bp1, bp2))
-        
-    for y in range(8):
-        bp3 = 0
-        bp4 = 0
-        
-        for x in range(8):
-            pixel = tile.pixelIndex(x, y)
-            a = pixel & 0x4
-            b = pixel & 0x8
-            
-            if a:
-                bp3 += 2**(7-x)
-            if b:
-                bp4 += 2**(7-x)
-        
-        data.extend((bp3, bp4))
-        
-    return bytes(data)
+    return image, filename, tiles, time.perf_counter() - start
 
 
-def padded4_2(tile, palette):
-    data = bytearray()
+def convert_batch(jobs, backend='qt', workers=1, stream=False):
+    """Converts (image, format) pairs across a pool of worker processes.
 
-    for y in range(8):
-        bp1 = 0
-        bp2 = 0
-
-        for x in range(8):
-            pixel = tile.pixelIndex(x, y)
-            if palette is not None:
-                pixel = palette[pixel]
-
-            a = pixel & 0x1
-            b = pixel & 0x2
-
-            if a:
-                bp1 += 2**(7 - x)
-            if b:
-                bp2 += 2**(7 - x)
-
-        data.extend((bp1, bp2))
-        
-    for y in range(8):
-        bp3 = 0
-        bp4 = 0
-        
-        data.extend((bp3, bp4))
-        
-    return bytes(data)
-
-
-def planar4(tile, palette):
-    data = bytearray()
-
-    for y in range(8):
-        byte = 0
-
-        for x in range(2):
-            pixel = tile.pixelIndex(x, y)
-            if palette is not None:
-                pixel = palette[pixel]
-            pixel &= 0x7
-            byte = byte + (pixel << x * 4)
-
-        data.append(byte)
-        byte = 0
-
-        for x in range(2, 4):
-            pixel = tile.pixelIndex(x, y)
-            pixel &= 0x7
-            byte = byte + (pixel << x * 4)
-
-        data.append(byte)
-        byte = 0
-
-        for x in range(4, 6):
-            pixel = tile.pixelIndex(x, y)
-            pixel &= 0x7
-            byte = byte + (pixel << x * 4)
-
-        data.append(byte)
-        byte = 0
-
-        for x in range(6, 8):
-            pixel = tile.pixelIndex(x, y)
-            pixel &= 0x7
-            byte = byte + (pixel << x * 4)
-
-        data.append(byte)
-
-    return bytes(data)
-
-
-# Add new formats to this dict as they are implemented.
-formats = {
-    'linear1':  linear1,
-    'linear2':  linear2,
-    'planar2':  planar2,
-    'nes2':     planar2,
-    'gb2':      linear2,
-    'snes2':    linear2,
-    'gbc2':     linear2,
-    'linear4':  linear4,
-    'planar4':  planar4,
-    'snes4':    linear4,
-    'pce4':     linear4,
-    'padded4_2': padded4_2
-}
+    Yields (image, output filename, tiles, seconds) in the order given.
+    """
+    if workers > 1:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers, initializer=_init, initargs=(backend, stream)) as pool:
+            for result in pool.imap(_convert, jobs):
+                yield result
+    else:
+        _init(backend, stream)
+        for job in jobs:
+            yield _convert(job)
 
 
 def main():
-    app = QGuiApplication(sys.argv)
-
-    if len(sys.argv) < 3 or sys.argv[2] not in formats.keys():
-        print(
-            '''Usage: porygon.py image format
-
-image is an image file in PNG. The base filename is also used to find a
-mapper in order to force palette modifications.
-
-format is one of the supported formats:'''
-        )
-        for fmt in formats.keys():
-            print('* {}'.format(fmt))
-        sys.exit(1)
-
-    (image, fmt) = sys.argv[1:3]
-    (image_base, ext) = op.splitext(image)
-    output = '{}.bin'.format(image_base)
-    mapper = image_base + '.txt'
-
-    if not op.exists('output/'):
-        import os
-        os.mkdir('output')
-    if not output.startswith('output/'):
-        output = 'output/{}'.format(output)
-
-    bpp = int(fmt[-1])
-
-    print('Loading image...')
-    data = QImage(image)
-    data = data.convertToFormat(QImage.Format_Indexed8)
-    if data.colorCount() > 2**bpp:
-        raise ValueError('image has too many colors')
-
-    width = data.width()
-    height = data.height()
-    rows = int(height / 8)
-    columns = int(width / 8)
-
-    palette = {}
-    if op.exists(mapper):
-        print('Palette found. Loading...')
-        with open(mapper, mode='r') as f:
-            text = f.read().split('\n')
-
-        for line in text:
-            if line == '':
-                continue
-            a = line.split('=')
-
-            key = int(a[0])
-            value = int(a[1])
-            palette[key] = value
-    else:
-        print('No palette found.')
-        palette = None
-
-    print('Converting to {}'.format(fmt))
-    counter = 0
-    with open(output, mode='wb') as f:
-        for row in range(rows):
-            for column in range(columns):
-                tile = data.copy(column * 8, row * 8, 8, 8)
-                f.write(formats[fmt](tile, palette))
-                counter += 1
+    parser = argparse.ArgumentParser(
+        description='''image is an image file in PNG. The base filename is also used
+to find a mapper in order to force palette modifications.''',
+        epilog='format is one of the supported formats: {}'.format(', '.join(formats.keys()))
+    )
+    parser.add_argument('image', nargs='?')
+    parser.add_argument('format', nargs='?', choices=formats.keys(), metavar='format')
+    parser.add_argument('--backend', choices=backends.keys(), default='qt',
+                        help='image loading backend (default: qt)')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help="convert every 'image format' line of FILE; images may be glob patterns")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of images to convert in parallel (default: 1)')
+    parser.add_argument('--stream', action='store_true',
+                        help='convert 8-pixel bands as they are decoded, to bound memory use')
+    args = parser.parse_args()
+
+    if args.manifest is None:
+        if args.image is None or args.format is None:
+            parser.error('an image and a format are required unless --manifest is given')
+        convert(args.image, args.format, args.backend, stream=args.stream)
+        return
+
+    jobs = read_manifest(args.manifest)
+    if args.image is not None:
+        if args.format is None:
+            parser.error('a format is required for {}'.format(args.image))
+        jobs.insert(0, (args.image, args.format))
+
+    (total_tiles, total_time) = (0, 0.0)
+    for image, filename, tiles, seconds in convert_batch(jobs, args.backend, args.jobs, args.stream):
+        print('{} -> {}: {} tiles in {:.3f}s'.format(image, filename, tiles, seconds))
+        total_tiles += tiles
+        total_time += seconds
+
+    print('{} files, {} tiles converted in {:.3f}s.'.format(len(jobs), total_tiles, total_time))
 
 
 if __name__ == '__main__':
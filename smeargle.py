@@ -13,28 +13,126 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
 # IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-import sys
+import argparse
 import os
 
-from PyQt5.QtGui import QGuiApplication
-
+from smeargle.backend import backends
 from smeargle.game import Game
+from smeargle.metrics import Metrics
+from smeargle.parallel import render_scripts, render_sharded
+from smeargle.server import make_server
+from smeargle.watch import Watcher
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Renders the scripts of a game to tiles and tilemaps.',
+        epilog='Please see the included readme.txt for documentation on file formats.'
+    )
+    parser.add_argument('game', help='game JSON file')
+    parser.add_argument('output', nargs='?', default='output', help='output directory (default: output)')
+    parser.add_argument('--backend', choices=backends.keys(), default='qt',
+                        help='rendering backend (default: qt)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of scripts to render in parallel (default: 1)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='split each script into this many shards, rendered in parallel (default: 1)')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='build cache directory (default: .smeargle-cache in the output directory)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always render every script')
+    parser.add_argument('--line-cache', type=int, default=16384, metavar='N',
+                        help='number of rendered lines to keep for reuse (default: 16384; 0 disables)')
+    parser.add_argument('--no-font-cache', action='store_true',
+                        help='neither read nor write compiled .fontcache files')
+    parser.add_argument('--watch', action='store_true',
+                        help='after rendering, keep rendering again whenever an input file changes')
+    parser.add_argument('--interval', type=float, default=0.25, metavar='SECONDS',
+                        help='how often --watch checks for changes (default: 0.25)')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='instead of rendering, answer line preview requests over HTTP on PORT')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address for --serve to listen on (default: 127.0.0.1)')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write per-script stage timings, memory use and counts to FILE as JSON')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='leave peak memory out of --metrics, which otherwise slows rendering down')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='write cProfile statistics for each script to DIR')
+    args = parser.parse_args()
+
+    if args.watch and (args.jobs > 1 or args.shards > 1):
+        parser.error('--watch renders in a single process; it cannot be combined with --jobs or --shards')
+    if args.serve is not None and (args.watch or args.jobs > 1 or args.shards > 1):
+        parser.error('--serve cannot be combined with --watch, --jobs or --shards')
+
+    render_path = args.output
+    if not os.path.exists(render_path):
+        os.mkdir(render_path, mode=0o644)
+
+    if args.no_cache:
+        cache = None
+    elif args.cache is not None:
+        cache = args.cache
+    else:
+        cache = os.path.join(render_path, '.smeargle-cache')
+
+    print('Loading game data from {}...'.format(args.game), end='')
+    font_cache = not args.no_font_cache
+    if args.metrics is not None or args.profile is not None:
+        metrics = Metrics(memory=args.metrics is not None and not args.no_memory, profile=args.profile)
+    else:
+        metrics = None
+    game = Game(args.game, backend=args.backend, cache=cache, line_cache=args.line_cache, font_cache=font_cache,
+                metrics=metrics)
+    print('done.')
+
+    if args.serve is not None:
+        server = make_server(game, args.host, args.serve)
+        print('Serving previews on http://{}:{}/; press Ctrl-C to stop.'.format(*server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('Stopped serving.')
+        finally:
+            server.server_close()
+        return
+
+    if args.shards > 1:
+        jobs = args.jobs if args.jobs > 1 else args.shards
+        results = render_sharded(game, args.game, render_path, args.shards, jobs, args.backend, args.line_cache,
+                                 font_cache)
+    elif args.jobs > 1:
+        results = render_scripts(args.game, render_path, game.targets, args.jobs, args.backend, cache,
+                                 args.line_cache, font_cache, game.metrics)
+    else:
+        results = None
+
+    if results is not None:
+        for script, log in results:
+            print('Processing {}...'.format(script))
+            print(log, end='')
+            print('{} processed.'.format(script))
+    else:
+        for script in game.targets:
+            print('Processing {}...'.format(script))
+            game.render(script, render_path, output=True)
+            print('{} processed.'.format(script))
+
+        lines = game.line_cache
+        if lines.hits + lines.misses > 0:
+            print('Line cache: {} hits, {} misses ({:.1%} hit rate).'.format(
+                lines.hits, lines.misses, lines.hit_rate
+            ))
+        if game.cache is not None:
+            print('Build cache: {} hits, {} misses.'.format(game.cache.hits, game.cache.misses))
 
-if len(sys.argv) < 1:
-    print('Usage: smeargle.py game.json [output_directory]')
-    print('\nPlease see the included readme.txt for documentation on file formats.')
-    sys.exit(-1)
+    if args.metrics is not None:
+        game.metrics.save(args.metrics)
 
-app = QGuiApplication(sys.argv)
-render_path = sys.argv[2] if len(sys.argv) > 2 else 'output'
-if not os.path.exists(render_path):
-    os.mkdir(render_path, mode=0o644)
+    if args.watch:
+        Watcher(game, render_path, interval=args.interval).run()
 
-print('Loading game data from {}...'.format(sys.argv[1]), end='')
-game = Game(sys.argv[1])
-print('done.')
 
-for script in game.scripts:
-    print('Processing {}...'.format(script))
-    game.render_script(script, render_path, output=True)
-    print('{} processed.'.format(script))
+if __name__ == '__main__':
+    main()
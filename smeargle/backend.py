@@ -0,0 +1,255 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import sys
+
+import numpy as np
+
+from smeargle import png
+
+
+def quantize(rgb, palette):
+    """Maps an (h, w, 3) RGB array to the nearest colours of the palette."""
+    colors = np.array(palette, dtype=np.int32).reshape(-1, 1, 1, 3)
+    distance = ((rgb.astype(np.int32) - colors) ** 2).sum(axis=3)
+
+    return distance.argmin(axis=0).astype(np.uint8)
+
+
+class QtBackend:
+    """Renders with QPainter and QImage. This is the reference backend."""
+
+    name = 'qt'
+
+    def __init__(self):
+        from PyQt5.QtGui import QGuiApplication, QImage, QPainter, QPixmap, QColor
+
+        self._app = QGuiApplication.instance() or QGuiApplication(sys.argv[:1])
+        self._painter = QPainter()
+        self._QImage = QImage
+        self._QPixmap = QPixmap
+        self._QColor = QColor
+
+    def rgb(self, palette):
+        return [self._QColor(*color).rgb() for color in palette]
+
+    def load_image(self, filename, palette):
+        return self._QPixmap(filename)
+
+    def size(self, image):
+        return image.width(), image.height()
+
+    def has_alpha(self, image):
+        return image.hasAlphaChannel()
+
+    def crop(self, image, x, y, width, height):
+        return image.copy(x, y, width, height).toImage()
+
+    def pixel(self, image, x, y):
+        return self._QColor(image.pixel(x, y)).getRgb()[:3]
+
+    def from_pixels(self, pixels, palette):
+        """Converts a 2D array of palette indices to an RGB32 QImage."""
+        (height, width) = pixels.shape
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        image = self._QImage(pixels.data, width, height, width, self._QImage.Format_Indexed8)
+        image.setColorTable(self.rgb(palette))
+
+        return image.convertToFormat(self._QImage.Format_RGB32)
+
+    def to_pixels(self, image, palette):
+        """Converts a QImage to a 2D array of indices into the given palette."""
+        QImage = self._QImage
+
+        if len(palette) > 1:
+            image = image.convertToFormat(QImage.Format_Indexed8, self.rgb(palette))
+        else:
+            image = image.convertToFormat(QImage.Format_Indexed8)
+
+        return self._indices(image)
+
+    def _indices(self, image):
+        ptr = image.constBits()
+        ptr.setsize(image.bytesPerLine() * image.height())
+        pixels = np.frombuffer(ptr, dtype=np.uint8)
+        pixels = pixels.reshape(image.height(), image.bytesPerLine())
+
+        return pixels[:, :image.width()].copy()
+
+    def load_indexed(self, filename):
+        """Loads an image as palette indices, returning them and the colour count."""
+        image = self._QImage(filename).convertToFormat(self._QImage.Format_Indexed8)
+
+        return self._indices(image), image.colorCount()
+
+    def render_line(self, font, glyphs, length):
+        """Draws (position, glyph index) pairs onto a fresh line image."""
+        image = self._QImage(length, font.height, self._QImage.Format_RGB32)
+        image.fill(self.rgb(font.palette)[0])
+
+        self._painter.begin(image)
+        for pos, idx in glyphs:
+            self._painter.drawImage(pos, 0, font.index(idx))
+        self._painter.end()
+
+        return image
+
+    def save(self, pixels, palette, filename):
+        (height, width) = pixels.shape
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        image = self._QImage(pixels.data, width, height, width, self._QImage.Format_Indexed8)
+        image.setColorTable(self.rgb(palette))
+        image.save(filename, 'PNG')
+
+    def save_bands(self, bands, width, height, palette, filename):
+        """Saves an image given as an iterable of bands of rows.
+
+        Qt cannot encode a PNG incrementally, so the bands are copied into a
+        single indexed image, one byte per pixel, which is then saved.
+        """
+        pixels = np.zeros((height, width), dtype=np.uint8)
+        y = 0
+        for band in bands:
+            pixels[y:y + band.shape[0]] = band
+            y += band.shape[0]
+
+        self.save(pixels, palette, filename)
+
+
+class ArrayBackend:
+    """Composites palette indices with NumPy; does not need Qt at all."""
+
+    name = 'array'
+
+    def load_image(self, filename, palette):
+        if not palette:
+            raise ValueError('the array backend requires a font palette')
+
+        with png.Reader(filename) as reader:
+            if reader.transparent:
+                raise ValueError('the array backend does not support transparent font images')
+
+        (pixels, colors) = png.read(filename)
+        if colors is None:
+            return quantize(pixels, palette)
+
+        mapping = quantize(np.array(colors, dtype=np.uint8).reshape(1, -1, 3), palette)
+        return mapping[0][pixels]
+
+    def size(self, image):
+        return image.shape[1], image.shape[0]
+
+    def has_alpha(self, image):
+        return False
+
+    def crop(self, image, x, y, width, height):
+        glyph = np.zeros((height, width), dtype=np.uint8)
+        area = image[y:y + height, x:x + width]
+        glyph[:area.shape[0], :area.shape[1]] = area
+
+        return glyph
+
+    def from_pixels(self, pixels, palette):
+        return pixels
+
+    def to_pixels(self, image, palette):
+        return image
+
+    def load_indexed(self, filename):
+        """Loads an image as palette indices, returning them and the colour count.
+
+        Truecolour images are indexed in order of first appearance.
+        """
+        (pixels, colors) = png.read(filename)
+        if colors is not None:
+            return pixels, len(colors)
+
+        known = {}
+        pixels = self._index_colors(pixels, known)
+
+        return pixels, len(known)
+
+    def load_bands(self, filename, rows):
+        """Like load_indexed, but yields the image a band of rows at a time.
+
+        Each band is yielded with the number of colours seen so far.
+        """
+        with png.Reader(filename) as reader:
+            known = {}
+
+            for band in reader.bands(rows):
+                if reader.indexed:
+                    yield band, len(reader.palette)
+                else:
+                    band = self._index_colors(band, known)
+                    yield band, len(known)
+
+    def _index_colors(self, rgb, known):
+        """Indexes RGB pixels, extending known (colour -> index) in scan order."""
+        packed = rgb.astype(np.uint32)
+        packed = (packed[:, :, 0] << 16) | (packed[:, :, 1] << 8) | packed[:, :, 2]
+        (colors, first, inverse) = np.unique(packed, return_index=True, return_inverse=True)
+
+        for i in np.argsort(first):
+            known.setdefault(int(colors[i]), len(known))
+        if len(known) > 256:
+            raise ValueError('image has too many colors')
+
+        lut = np.array([known[int(color)] for color in colors], dtype=np.uint8)
+        return lut[inverse].reshape(packed.shape)
+
+    def render_line(self, font, glyphs, length):
+        """Copies (position, glyph index) pairs into a fresh line of indices."""
+        image = np.zeros((font.height, length), dtype=np.uint8)
+
+        for pos, idx in glyphs:
+            width = min(font.width, length - pos)
+            image[:, pos:pos + width] = font.pixels(idx)[:, :width]
+
+        return image
+
+    def save(self, pixels, palette, filename):
+        if pixels.size > 0:
+            png.write(filename, pixels, palette)
+
+    def save_bands(self, bands, width, height, palette, filename):
+        """Saves an image given as an iterable of bands of rows, encoding
+        each band as soon as it is produced."""
+        if width * height == 0:
+            return
+
+        with png.Writer(filename, width, height, palette) as writer:
+            for band in bands:
+                writer.write(band)
+
+
+backends = {
+    'qt':    QtBackend,
+    'array': ArrayBackend,
+}
+
+_instances = {}
+
+
+def get_backend(name):
+    """Returns the shared instance of the named backend, creating it if needed."""
+    if name not in backends:
+        raise ValueError('backend must be one of {}'.format(list(backends.keys())))
+    if name not in _instances:
+        _instances[name] = backends[name]()
+
+    return _instances[name]
+
+
+__all__ = ['backends', 'get_backend']
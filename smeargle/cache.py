@@ -0,0 +1,161 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import hashlib
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+# Bump this whenever a change to Smeargle alters its output, so that
+# entries written by older versions are never reused.
+VERSION = b'smeargle-cache-1'
+
+
+def fingerprint(*parts):
+    """Hashes a sequence of byte strings into a hex digest."""
+    digest = hashlib.sha256(VERSION)
+
+    for part in parts:
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+
+    return digest.hexdigest()
+
+
+class BuildCache:
+    """An on-disk cache of script outputs, addressed by a fingerprint of their inputs.
+
+    Each entry is a directory named after its fingerprint, holding copies of
+    the output files. Files written beside an output, such as the pages of a
+    paged tile sheet, are kept with it and restored beside it. Only the most
+    recent entry for each script is kept.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, key):
+        return os.path.join(self._path, key)
+
+    def restore(self, key, outputs):
+        """Copies a cached entry's files to the given paths, if the entry exists."""
+        entry = self._entry(key)
+
+        if not os.path.isdir(entry):
+            self.misses += 1
+            return False
+
+        for i, dst in enumerate(outputs):
+            src = os.path.join(entry, str(i))
+            if os.path.exists(src):
+                shutil.copyfile(src, dst)
+
+        beside = os.path.join(entry, 'beside.json')
+        if os.path.exists(beside):
+            with open(beside, mode='rt') as f:
+                for i, names in json.load(f).items():
+                    directory = os.path.dirname(outputs[int(i)])
+                    for j, name in enumerate(names):
+                        shutil.copyfile(os.path.join(entry, '{}-{}'.format(i, j)), os.path.join(directory, name))
+
+        self.hits += 1
+        return True
+
+    def store(self, script, key, outputs, beside=None):
+        """Stores copies of the output files of a script under a key.
+
+        beside, if given, maps the position of an output to a list of files
+        in the same directory which belong with it.
+        """
+        entry = self._entry(key)
+        temp = entry + '.tmp'
+
+        if os.path.exists(temp):
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+
+        for i, src in enumerate(outputs):
+            if os.path.exists(src):
+                shutil.copyfile(src, os.path.join(temp, str(i)))
+
+        if beside:
+            for i, files in beside.items():
+                for j, src in enumerate(files):
+                    shutil.copyfile(src, os.path.join(temp, '{}-{}'.format(i, j)))
+            with open(os.path.join(temp, 'beside.json'), mode='wt') as f:
+                json.dump({i: [os.path.basename(src) for src in files] for i, files in beside.items()}, f)
+
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(temp, entry)
+
+        # Drop the script's previous entry, now that it can never be hit again.
+        pointer = os.path.join(self._path, hashlib.sha256(script.encode('UTF-8')).hexdigest() + '.last')
+        if os.path.exists(pointer):
+            with open(pointer, mode='rt') as f:
+                previous = f.read().strip()
+            if previous != key and os.path.exists(self._entry(previous)):
+                shutil.rmtree(self._entry(previous))
+
+        with open(pointer, mode='wt') as f:
+            f.write(key)
+
+
+class LineCache:
+    """A bounded, least-recently-used cache of rendered lines.
+
+    A single instance is shared by every script in a Game, so that a line
+    repeated anywhere in the game is only rendered and sliced into tiles once.
+    """
+
+    def __init__(self, size=16384):
+        self._entries = OrderedDict()
+        self._size = size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key]
+
+    def put(self, key, value):
+        if self._size <= 0:
+            return
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+__all__ = ['BuildCache', 'LineCache', 'fingerprint']
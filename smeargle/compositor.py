@@ -0,0 +1,78 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import numpy as np
+
+
+class BitmaskCompositor:
+    """Composites lines of a font of up to four colours with integer arithmetic.
+
+    Each column of a glyph is packed into a word of height * depth bits, and
+    the columns of a glyph or line into one Python integer, leftmost column
+    lowest. Drawing a glyph at a position is then a single shift, mask and
+    or, and the finished line unpacks straight into palette indices.
+    """
+
+    def __init__(self, font):
+        colors = len(font.palette)
+        if colors > 4:
+            raise ValueError('the bitmask compositor needs a font of at most 4 colors')
+        if font.transparent:
+            raise ValueError('the bitmask compositor needs a font image without transparency')
+
+        self._font = font
+        self._depth = 1 if colors <= 2 else 2
+        self._glyphs = {}
+
+        bits = font.height * self._depth
+        for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+            if np.dtype(dtype).itemsize * 8 >= bits:
+                break
+        else:
+            raise ValueError('font is too tall for the bitmask compositor')
+
+        self._dtype = np.dtype(dtype).newbyteorder('<')
+        self._word = self._dtype.itemsize * 8
+        self._cell = (1 << (self._word * font.width)) - 1
+        self._shifts = (np.arange(font.height) * self._depth).astype(self._dtype)[:, np.newaxis]
+        self._mask = self._dtype.type((1 << self._depth) - 1)
+
+    @property
+    def font(self):
+        return self._font
+
+    def glyph(self, idx):
+        """Returns the columns of a glyph packed into an integer."""
+        if idx not in self._glyphs:
+            pixels = self._font.pixels(idx).astype(self._dtype)
+            columns = np.bitwise_or.reduce(pixels << self._shifts, axis=0).astype(self._dtype)
+            self._glyphs[idx] = int.from_bytes(columns.tobytes(), 'little')
+
+        return self._glyphs[idx]
+
+    def render_line(self, glyphs, length):
+        """Draws (position, glyph index) pairs onto a line of the background
+        colour, like a backend's render_line, and returns its palette indices."""
+        line = 0
+        for pos, idx in glyphs:
+            shift = pos * self._word
+            line = (line & ~(self._cell << shift)) | (self.glyph(idx) << shift)
+
+        line &= (1 << (length * self._word)) - 1
+        columns = np.frombuffer(line.to_bytes(length * self._word // 8, 'little'), dtype=self._dtype)
+
+        return ((columns >> self._shifts) & self._mask).astype(np.uint8)
+
+
+__all__ = ['BitmaskCompositor']
@@ -13,61 +13,208 @@
 # IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 import json
+import os
+import struct
+
+import numpy as np
+
+from smeargle.backend import get_backend
+
+# Compiled fonts start with this, followed by the length of a JSON header,
+# the header itself and the glyphs as an (n, height, width) array of indices.
+MAGIC = b'SMEARGLE-FONT-2\n'
+
+
+def compiled_filename(filename):
+    """Returns the filename of the compiled form of a font JSON file."""
+    return os.path.splitext(filename)[0] + '.fontcache'
+
+
+def _stamp(filename):
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_compiled(filename, backend):
+    """Loads a compiled font, if it is still valid for its sources and backend.
+
+    Returns the font JSON, the palette and a read-only memory map of the
+    glyphs, or None.
+    """
+    cache = compiled_filename(filename)
+
+    try:
+        with open(cache, mode='rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            (size,) = struct.unpack('>I', f.read(4))
+            header = json.loads(f.read(size).decode('UTF-8'))
+
+        if header['backend'] != backend or header['font_stamp'] != _stamp(filename):
+            return None
+        if header['image_stamp'] != _stamp(header['font']['filename']):
+            return None
+
+        glyphs = np.memmap(cache, dtype=np.uint8, mode='r', offset=header['offset'],
+                           shape=tuple(header['shape']))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return header['font'], [tuple(color) for color in header['palette']], glyphs
+
+
+def save_compiled(filename, backend, font, palette, glyphs):
+    """Writes a compiled font next to its JSON file; failure is not an error."""
+    cache = compiled_filename(filename)
+    header = {
+        'backend': backend,
+        'font_stamp': _stamp(filename),
+        'image_stamp': _stamp(font['filename']),
+        'font': font,
+        'palette': palette,
+        'shape': glyphs.shape,
+        'offset': 0,
+    }
+
+    # The glyphs start at the first multiple of 16 bytes after the header.
+    size = len(json.dumps(header).encode('UTF-8')) + 16
+    header['offset'] = -(-(len(MAGIC) + 4 + size) // 16) * 16
+    data = json.dumps(header).encode('UTF-8')
+    data += b' ' * (header['offset'] - len(MAGIC) - 4 - len(data))
+
+    try:
+        temp = '{}.{}.tmp'.format(cache, os.getpid())
+        with open(temp, mode='wb') as f:
+            f.write(MAGIC + struct.pack('>I', len(data)) + data)
+            f.write(np.ascontiguousarray(glyphs, dtype=np.uint8).tobytes())
+        os.replace(temp, cache)
+    except OSError:
+        pass
 
-from PyQt5.QtGui import QPixmap, QColor
 
 class Font:
     """A simple class for managing Smeargle's font data."""
 
-    def __init__(self, filename):
+    def __init__(self, filename, backend='qt', compiled=True):
         """Creates the font object.
 
-        Takes a filename pointing at the JSON metadata for a font.
+        Takes a filename pointing at the JSON metadata for a font, and the
+        name of the rendering backend to load it with. Unless compiled is
+        false, the font is loaded from its compiled form when that is up to
+        date, and compiled for next time when it is not.
         """
+        self._filename = filename
+        self._backend = get_backend(backend)
+        self._glyphs = {}
+        self._pixels = {}
+        self._image = None
+        self._widths = None
+        self._transparent = False
+
+        loaded = load_compiled(filename, backend) if compiled else None
+        if loaded is not None:
+            (self._json, self._colors, self._compiled) = loaded
+            return
+
         with open(filename, mode='rb') as f:
             self._json = json.load(f)
 
-        self._image = QPixmap(self._json['filename'])
         self._colors = []
+        self._compiled = None
 
         if 'palette' in self._json:
             for color in self._json['palette']:
                 if isinstance(color, (list, tuple)):
-                    self._colors.append(QColor(*color))
+                    self._colors.append(tuple(color))
                 elif isinstance(color, str):
                     red   = int(color[0:2], 16)
                     green = int(color[2:4], 16)
                     blue  = int(color[4:6], 16)
-                    self._colors.append(QColor(red, green, blue).rgb())
+                    self._colors.append((red, green, blue))
                 else:
                     raise ValueError('unsupported color format: {}'.format(color))
-        else:
+
+        self._image = self._backend.load_image(self._json['filename'], self._colors)
+        self._transparent = self._backend.has_alpha(self._image)
+
+        if not self._colors:
             print("WARNING: No palette was provided with this font. Output palette order cannot be guaranteed.")
             tile = self.index(self.table[' ']['index'])
-            self._colors = [tile.toImage().pixel(0, 0).rgb()]
+            self._colors = [self._backend.pixel(tile, 0, 0)]
+        elif compiled and len(self._colors) > 1 and not self._transparent:
+            # Glyphs are drawn from the font's character map, at index - 1.
+            # Fonts with transparency are never compiled: palette indices
+            # cannot let the background or earlier glyphs show through.
+            count = max(entry['index'] for entry in self.table.values())
+            glyphs = np.array([self.pixels(idx) for idx in range(count)], dtype=np.uint8)
+            save_compiled(filename, backend, self._json, self._colors, glyphs)
 
     def index(self, idx):
         """Given an index, returns the character at that location in the font.
 
         Please note that this function assumes that even variable-width fonts
-        are stored in a fixed-width grid.
+        are stored in a fixed-width grid. Glyphs are sliced out of the font
+        image on first use and cached thereafter.
         """
-        tpr = int(self._image.width() / self.width)
+        if idx in self._glyphs:
+            return self._glyphs[idx]
+
+        if self._compiled is not None and 0 <= idx < len(self._compiled):
+            glyph = self._backend.from_pixels(self._compiled[idx], self.palette)
+            self._glyphs[idx] = glyph
+            return glyph
+
+        if self._image is None:
+            self._image = self._backend.load_image(self._json['filename'], self._colors)
+
+        (image_width, image_height) = self._backend.size(self._image)
+        tpr = int(image_width / self.width)
         row = int(idx / tpr)
         column = idx % tpr
 
         x = column * self.width
         y = row * self.height
 
-        if (x > self._image.width()) or (y > self._image.height()):
+        if (x > image_width) or (y > image_height):
             raise ValueError('out of bounds: {}'.format(idx))
 
-        return self._image.copy(x, y, self.width, self.height).toImage()
+        glyph = self._backend.crop(self._image, x, y, self.width, self.height)
+        self._glyphs[idx] = glyph
+
+        return glyph
+
+    def pixels(self, idx):
+        """Like index(), but returns the glyph as an array of palette indices."""
+        if idx not in self._pixels:
+            if self._compiled is not None and 0 <= idx < len(self._compiled):
+                self._pixels[idx] = self._compiled[idx]
+            else:
+                self._pixels[idx] = self._backend.to_pixels(self.index(idx), self.palette)
+
+        return self._pixels[idx]
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def image_filename(self):
+        return self._json['filename']
+
+    @property
+    def backend(self):
+        return self._backend
 
     @property
     def palette(self):
+        """The font's colours as (r, g, b) tuples; the first is the background."""
         return self._colors
 
+    @property
+    def transparent(self):
+        """Whether the font image has an alpha channel."""
+        return self._transparent
+
     @property
     def width(self):
         return self._json['width']
@@ -80,6 +227,33 @@ class Font:
     def table(self):
         return self._json['map']
 
+    def _codepoint_table(self):
+        """Builds arrays of the width and index of each character, by codepoint.
+
+        Characters missing from the font have a width of -1.
+        """
+        size = max((ord(char) for char in self.table), default=-1) + 1
+        self._widths = np.full(size + 1, -1, dtype=np.int32)
+        self._indices = np.zeros(size + 1, dtype=np.int32)
+
+        for char, entry in self.table.items():
+            self._widths[ord(char)] = entry['width']
+            self._indices[ord(char)] = entry['index']
+
+    def measure(self, text):
+        """Returns the width and glyph index of each character of a string, as arrays."""
+        if self._widths is None:
+            self._codepoint_table()
+
+        codepoints = np.frombuffer(text.encode('UTF-32-LE'), dtype='<u4')
+        codepoints = np.minimum(codepoints, len(self._widths) - 1)
+        widths = self._widths[codepoints]
+
+        if len(widths) and widths.min() < 0:
+            raise KeyError(text[int(np.argmin(widths))])
+
+        return widths, self._indices[codepoints]
+
     def length(self, text):
         """Calculate the pixel-wise length of the given string."""
-        return sum(self.table[x]['width'] for x in text)
+        return int(self.measure(text)[0].sum())
@@ -0,0 +1,143 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Tile graphics encoders shared by porygon.py and Smeargle's binary output."""
+
+import numpy as np
+
+
+def _mapped(tiles, palette):
+    """Applies a porygon palette mapper (a dict of index -> index) to tiles."""
+    tiles = tiles.astype(np.int64)
+    if palette is None:
+        return tiles
+
+    lut = np.zeros(256, dtype=np.int64)
+    known = np.zeros(256, dtype=bool)
+    for key, value in palette.items():
+        if 0 <= key < 256:
+            lut[key] = value
+            known[key] = True
+
+    missing = ~known[tiles]
+    if missing.any():
+        raise KeyError(int(tiles[missing][0]))
+
+    return lut[tiles]
+
+
+def _plane(tiles, bit):
+    """Packs one bitplane of (n, 8, 8) tiles into an (n, 8) array of bytes."""
+    return np.packbits((tiles & bit) != 0, axis=2)[:, :, 0]
+
+
+def _overflow(fmt):
+    # The original per-pixel encoders shifted these pixels past the end of
+    # their byte and failed; keep refusing them rather than change output.
+    raise ValueError('{}: pixel values do not fit in a byte'.format(fmt))
+
+
+# Every encoder takes an (n, 8, 8) array of palette indices and an optional
+# palette mapper, and returns the encoded bytes of all n tiles in order.
+
+def linear1(tiles, *args):
+    tiles = tiles.astype(np.int64)
+    if (tiles[:, :, 0] > 0).any():
+        _overflow('linear1')
+
+    bits = np.zeros(tiles.shape, dtype=bool)
+    bits[:, :, :7] = tiles[:, :, 1:] > 0
+
+    return np.packbits(bits, axis=2).tobytes()
+
+
+def linear2(tiles, palette):
+    pixels = _mapped(tiles, palette)
+
+    return np.stack((_plane(pixels, 0x1), _plane(pixels, 0x2)), axis=2).tobytes()
+
+
+def planar2(tiles, palette):
+    if (tiles[:, :, 4:] & 0x3).any():
+        _overflow('planar2')
+
+    pixels = _mapped(tiles[:, :, :4], palette) & 0x3
+    data = np.zeros((len(tiles), 8, 2), dtype=np.uint8)
+    data[:, :, 0] = (pixels << np.array([0, 2, 4, 6])).sum(axis=2)
+
+    return data.tobytes()
+
+
+def linear4(tiles, palette):
+    pixels = _mapped(tiles, palette)
+    low = np.stack((_plane(pixels, 0x1), _plane(pixels, 0x2)), axis=2)
+    # The upper bitplanes have always been taken from the unmapped indices.
+    high = np.stack((_plane(tiles, 0x4), _plane(tiles, 0x8)), axis=2)
+
+    return np.concatenate((low, high), axis=1).tobytes()
+
+
+def padded4_2(tiles, palette):
+    pixels = _mapped(tiles, palette)
+    low = np.stack((_plane(pixels, 0x1), _plane(pixels, 0x2)), axis=2)
+
+    return np.concatenate((low, np.zeros_like(low)), axis=1).tobytes()
+
+
+def planar4(tiles, palette):
+    if (tiles[:, :, 2:] & 0x7).any():
+        _overflow('planar4')
+
+    pixels = _mapped(tiles[:, :, :2], palette) & 0x7
+    data = np.zeros((len(tiles), 8, 4), dtype=np.uint8)
+    data[:, :, 0] = pixels[:, :, 0] + (pixels[:, :, 1] << 4)
+
+    return data.tobytes()
+
+
+# Add new formats to this dict as they are implemented.
+formats = {
+    'linear1':  linear1,
+    'linear2':  linear2,
+    'planar2':  planar2,
+    'nes2':     planar2,
+    'gb2':      linear2,
+    'snes2':    linear2,
+    'gbc2':     linear2,
+    'linear4':  linear4,
+    'planar4':  planar4,
+    'snes4':    linear4,
+    'pce4':     linear4,
+    'padded4_2': padded4_2
+}
+
+
+def slice_tiles(pixels):
+    """Slices a 2D array of palette indices into (n, 8, 8) tiles, row by row.
+
+    Partial tiles at the right and bottom edges are skipped.
+    """
+    rows = int(pixels.shape[0] / 8)
+    columns = int(pixels.shape[1] / 8)
+    pixels = pixels[:rows * 8, :columns * 8].reshape(rows, 8, columns, 8)
+
+    return pixels.swapaxes(1, 2).reshape(rows * columns, 8, 8)
+
+
+def encode(pixels, fmt, palette=None):
+    """Encodes a 2D array of palette indices, 8x8 tiles at a time, row by row."""
+    return formats[fmt](slice_tiles(pixels), palette)
+
+
+__all__ = ['encode', 'formats', 'slice_tiles']
@@ -14,22 +14,74 @@
 
 import json
 import os.path
+from itertools import islice
 
+import numpy as np
+
+from smeargle.cache import BuildCache, LineCache, fingerprint
 from smeargle.font import Font
-from smeargle.script import Script
+from smeargle.formats import formats
+from smeargle.metrics import Metrics
+from smeargle.script import (
+    DEDUP_BATCH, Script, merge_tiles, orient_tiles, allocate_tiles, load_tile_dictionary, save_tile_dictionary
+)
+from smeargle.tiles import TileStore
+
+# Script options which belong to a shared tile bank when the script is in one.
+BANK_OPTIONS = {
+    'deduped_fn': None,
+    'tile_dictionary': None,
+    'reclaim_tiles': False,
+    'binary_format': None,
+    'binary_fn': None,
+    'write_images': True,
+    'tile_flips': False,
+    'page_tiles': 0,
+    'sheet_width': 16,
+}
 
 class Game:
-    def __init__(self, filename):
-        with open(filename, mode='rb') as f:
-            self._data = json.load(f)
+    def __init__(self, filename, backend='qt', cache=None, line_cache=16384, font_cache=True, metrics=None):
+        """Loads a game.
+
+        backend names the rendering backend to use. If cache is the path of
+        a directory, scripts whose inputs have not changed since they were
+        last rendered are restored from it instead of being rendered again.
+        line_cache is the number of rendered lines kept in memory for reuse
+        by every script; 0 disables it. font_cache selects whether fonts are
+        loaded from, and compiled to, .fontcache files beside their JSON.
+        metrics, if given, is a Metrics which records each target rendered.
+        """
+        self._filename = filename
+        self._backend = backend
+        self._font_cache = font_cache
+        self._cache = BuildCache(cache) if cache is not None else None
+        self._line_cache = LineCache(line_cache)
+        self._metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self._loaded = {}
+
+        self._load()
+
+    def _load(self):
+        """Reads game.json, reusing any fonts which are already loaded. Nothing
+        is changed unless the whole file loads."""
+        with open(self._filename, mode='rb') as f:
+            game = json.load(f)
 
-        self._fonts = {}
-        self._scripts = {}
+        fonts = {}
+        scripts = {}
+        banks = {}
 
-        for name, file in self._data['fonts'].items():
-            self._fonts[name] = Font(file)
+        # Fonts referenced under several names share a single glyph cache.
+        loaded = {}
+        for name, file in game['fonts'].items():
+            path = os.path.abspath(file)
+            if path not in loaded:
+                loaded[path] = self._loaded.get(path) or Font(file, self._backend, compiled=self._font_cache)
+            fonts[name] = loaded[path]
 
         valid_formats = ['thingy', 'atlas', None]
+        valid_compositors = ['painter', 'bitmask']
         defaults = {
             'max_tiles_per_line': 0,
             'min_tiles_per_line': 0,
@@ -40,9 +92,44 @@ class Game:
             'deduped_fn': None,
             'tilemap_fn': None,
             'little_endian': False,
+            'tile_dictionary': None,
+            'reclaim_tiles': False,
+            'binary_format': None,
+            'binary_fn': None,
+            'write_images': True,
+            'compositor': 'painter',
+            'wrap_lines': False,
+            'tile_flips': False,
+            'flip_bits': [14, 15],
+            'bank': None,
+            'page_tiles': 0,
+            'sheet_width': 16,
         }
+        bank_options = game.get('banks', {})
 
-        for script, data in self._data['scripts'].items():
+        for bank, options in bank_options.items():
+            for k, v in BANK_OPTIONS.items():
+                if k not in options:
+                    options[k] = v
+            if len(options) > len(BANK_OPTIONS):
+                raise ValueError("bank options must be among {}".format(list(BANK_OPTIONS.keys())))
+            if bank in game['scripts']:
+                raise ValueError("bank {} has the same name as a script".format(bank))
+
+        for script, data in game['scripts'].items():
+            bank = data.get('bank')
+            if bank is not None:
+                if bank not in bank_options:
+                    raise ValueError("script {} refers to unknown bank {}".format(script, bank))
+                for k in BANK_OPTIONS:
+                    if k in data:
+                        raise ValueError("{} must be set on bank {}, not on script {}".format(k, bank, script))
+                data.update(bank_options[bank])
+
+                members = banks.setdefault(bank, [])
+                if members and fonts[data['font']] is not scripts[members[0]][1]:
+                    raise ValueError("scripts in bank {} must all use the same font".format(bank))
+                members.append(script)
 
             # Add defaults to script data if not present
             for k, v in defaults.items():
@@ -51,12 +138,26 @@ class Game:
 
             if data['output_format'] not in valid_formats:
                 raise ValueError("output_format must be one of {} or omitted entirely".format(valid_formats[:-1]))
+            if data['binary_format'] is not None and data['binary_format'] not in formats:
+                raise ValueError("binary_format must be one of {} or omitted entirely".format(list(formats.keys())))
+            if data['compositor'] not in valid_compositors:
+                raise ValueError("compositor must be one of {} or omitted entirely".format(valid_compositors))
 
-            self._scripts[script] = (
+            scripts[script] = (
                 Script(filename=script, **data),
-                self._fonts[data['font']]
+                fonts[data['font']]
             )
 
+        self._data = game
+        self._loaded = loaded
+        self._fonts = fonts
+        self._scripts = scripts
+        self._banks = banks
+
+    @property
+    def name(self):
+        return self._data.get('name')
+
     @property
     def fonts(self):
         return tuple(self._fonts.keys())
@@ -65,57 +166,412 @@ class Game:
     def scripts(self):
         return tuple(self._scripts.keys())
 
-    def render_script(self, script, render_path, output=False):
-        if script not in self._scripts.keys():
-            raise KeyError('unknown script')
+    @property
+    def banks(self):
+        return tuple(self._banks.keys())
+
+    @property
+    def targets(self):
+        """The scripts to render, in order, with the scripts of each shared bank
+        replaced by the name of the bank, where its first script was."""
+        targets = []
+        for script, (data, font) in self._scripts.items():
+            if data.bank is None:
+                targets.append(script)
+            elif data.bank not in targets:
+                targets.append(data.bank)
+
+        return tuple(targets)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def line_cache(self):
+        return self._line_cache
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def filename(self):
+        return self._filename
+
+    def font(self, name):
+        """Returns the Font loaded under a name."""
+        return self._fonts[name]
+
+    def script(self, name):
+        """Returns the Script object of a script, and its Font."""
+        return self._scripts[name]
+
+    def inputs(self, target):
+        """The files a target is rendered from: its scripts, and their font's
+        JSON and image."""
+        members = self._banks.get(target, [target])
+        font = self._scripts[members[0]][1]
+
+        return tuple(members) + (font.filename, font.image_filename)
+
+    def reload(self):
+        """Reads game.json again. Fonts which are already loaded are kept, and
+        so are the line cache and build cache. If the file does not load, the
+        game is left as it was."""
+        self._load()
+
+    def reload_file(self, filename):
+        """Reloads a script, or a font from its JSON or image, after it has
+        changed. Returns the targets which need to be rendered again."""
+        path = os.path.abspath(filename)
+        changed = set()
+
+        for font_path, font in list(self._loaded.items()):
+            if path not in (font_path, os.path.abspath(font.image_filename)):
+                continue
+
+            reloaded = Font(font.filename, self._backend, compiled=self._font_cache)
+            self._loaded[font_path] = reloaded
+            for name in self._fonts:
+                if self._fonts[name] is font:
+                    self._fonts[name] = reloaded
+            for script, (data, script_font) in self._scripts.items():
+                if script_font is font:
+                    changed.add(script)
+
+            # Cached lines are keyed by the font's filename, not its contents.
+            self._line_cache.clear()
+
+        for script in self._scripts:
+            if os.path.abspath(script) == path:
+                changed.add(script)
+
+        for script in changed:
+            data = self._data['scripts'][script]
+            self._scripts[script] = (Script(filename=script, **data), self._fonts[data['font']])
+
+        return tuple(target for target in self.targets if set(self._banks.get(target, [target])) & changed)
+
+    def fingerprint(self, script, render_path):
+        """Hashes everything that affects the output of a script."""
+        data = self._data['scripts'][script]
+        font = self._fonts[data['font']]
+        parts = [
+            script.encode('UTF-8'),
+            self._backend.encode('UTF-8'),
+            json.dumps(data, sort_keys=True).encode('UTF-8'),
+        ]
+
+        for filename in (script, font.filename, font.image_filename):
+            with open(filename, mode='rb') as f:
+                parts.append(f.read())
+
+        # Stable tile allocation depends on the previous run's tile dictionary.
+        if data['tile_dictionary'] is not None:
+            dictionary = os.path.join(render_path, data['tile_dictionary'])
+            if os.path.exists(dictionary):
+                with open(dictionary, mode='rb') as f:
+                    parts.append(f.read())
 
-        filebase = os.path.split(script)[-1]
-        name, ext = os.path.splitext(filebase)
+        return fingerprint(*parts)
 
+    def bank_fingerprint(self, bank, render_path):
+        """Hashes everything that affects the output of a shared bank."""
+        parts = [b'bank', bank.encode('UTF-8')]
+        parts.extend(self.fingerprint(script, render_path).encode('UTF-8') for script in self._banks[bank])
+
+        return fingerprint(*parts)
+
+    def tile_shard(self, script, shard, shards):
+        """Renders and deduplicates one shard of a script; see merge_tiles."""
         script, font = self._scripts[script]
 
-        if script.raw_fn is None:
-            output_raw = os.path.join(render_path, name + '_raw.png')
+        return script.dedup_tiles(font, script.iter_lines(font, script.shard(shard, shards), self._line_cache))
+
+    def render(self, target, render_path, output=False, shards=1, shard_map=None):
+        """Renders one of the targets: a script, or a shared bank."""
+        if target in self._banks:
+            self.render_bank(target, render_path, output, shards, shard_map)
         else:
-            output_raw = os.path.join(render_path, script.raw_fn)
+            self.render_script(target, render_path, output, shards, shard_map)
+
+    def render_script(self, script, render_path, output=False, shards=1, shard_map=None):
+        """Renders a script and writes its output files.
+
+        If the script is in a shared bank, the whole bank is rendered. If
+        shard_map is given, the script is split into the given number of
+        shards instead, and shard_map(script, shards) must return a list of
+        (tile_shard result, console output) pairs, one per shard, in order.
+        """
+        if script not in self._scripts.keys():
+            raise KeyError('unknown script')
+        if self._scripts[script][0].bank is not None:
+            return self.render_bank(self._scripts[script][0].bank, render_path, output, shards, shard_map)
+
+        name = os.path.splitext(os.path.split(script)[-1])[0]
+        with self._metrics.target(script):
+            with self._metrics.stage('fingerprint'):
+                key = self.fingerprint(script, render_path) if self._cache is not None else None
+            self._render(script, name, [script], render_path, key, output, shards, shard_map)
+
+    def render_bank(self, bank, render_path, output=False, shards=1, shard_map=None):
+        """Renders the scripts of a shared bank into one set of tiles.
+
+        The bank's tiles are written once, named after the bank unless
+        configured otherwise, and each script gets its own raw tiles and
+        tilemap indexing into them. shards and shard_map are as for
+        render_script.
+        """
+        if bank not in self._banks:
+            raise KeyError('unknown bank')
+
+        with self._metrics.target(bank):
+            with self._metrics.stage('fingerprint'):
+                key = self.bank_fingerprint(bank, render_path) if self._cache is not None else None
+            self._render(bank, bank, self._banks[bank], render_path, key, output, shards, shard_map)
+
+    def _render(self, label, name, members, render_path, key, output, shards, shard_map):
+        """Renders scripts sharing one set of tiles; see render_script and render_bank."""
+        scripts = [self._scripts[member][0] for member in members]
+        (script, font) = self._scripts[members[0]]
 
         if script.deduped_fn is None:
             output_comp = os.path.join(render_path, name + '_compressed.png')
         else:
             output_comp = os.path.join(render_path, script.deduped_fn)
 
-        if script.tilemap_fn is None:
-            output_map = os.path.join(render_path, name + '_index.txt')
-        else:
-            output_map = os.path.join(render_path, script.tilemap_fn)
+        outputs = (script.sheet_filename(output_comp),)
+        maps = []
+
+        for member, data in zip(members, scripts):
+            base = os.path.splitext(os.path.split(member)[-1])[0]
+
+            if data.raw_fn is None:
+                output_raw = os.path.join(render_path, base + '_raw.png')
+            else:
+                output_raw = os.path.join(render_path, data.raw_fn)
+
+            if data.tilemap_fn is None:
+                output_map = os.path.join(render_path, base + '_index.txt')
+            else:
+                output_map = os.path.join(render_path, data.tilemap_fn)
+
+            outputs += (data.sheet_filename(output_raw), output_map)
+            maps.append((output_raw, output_map))
+
+        if script.tile_dictionary is not None:
+            output_dict = os.path.join(render_path, script.tile_dictionary)
+            outputs += (output_dict,)
+
+        if script.binary_format is not None:
+            if script.binary_fn is None:
+                output_bin = os.path.join(render_path, name + '.bin')
+            else:
+                output_bin = os.path.join(render_path, script.binary_fn)
+            outputs += (output_bin,)
+
+        metrics = self._metrics
+        (hits, misses) = (self._line_cache.hits, self._line_cache.misses)
 
+        with metrics.stage('restore'):
+            restored = key is not None and self._cache.restore(key, outputs)
+        if key is not None:
+            metrics.count(build_cache='hit' if restored else 'miss')
+        if restored:
+            if output:
+                print('Build cache hit; outputs restored.')
+                self._report(script, outputs, maps)
+            return
+        if key is not None and output:
+            print('Build cache miss.')
+
+        # Lines are read, rendered and deduplicated a batch at a time, and
+        # every script of a bank adds its tiles to the same store. Without
+        # flips or a tile dictionary, tiles keep the slots they are first
+        # given, so each batch's tilemap entries are written out at once
+        # instead of being held until the whole script is done.
         if output: print('Rendering text...')
-        lines = script.render_lines(font)
+        streaming = shard_map is None and not script.tile_flips and script.tile_dictionary is None
+        store = None
+        entries = []
+        counts = []
+        streamed = []
+        # Streamed tilemaps are written beside their outputs, and only replace
+        # them once every script has been deduplicated.
+        pending = []
+        try:
+            for member, data, (output_raw, output_map) in zip(members, scripts, maps):
+                start = len(entries)
+
+                if streaming:
+                    pending.append(('{}.{}.tmp'.format(output_map, os.getpid()), output_map))
+                    (store, ids, lines) = self._stream_tilemap(data, font, store, pending[-1][0])
+                    streamed.append((ids, lines))
+                    continue
+
+                if shard_map is not None:
+                    with metrics.stage('render_lines'):
+                        parts = shard_map(member, shards)
+                        for part, log in parts:
+                            print(log, end='')
+                    with metrics.stage('dedup_tiles'):
+                        (store, part) = merge_tiles([part for part, log in parts], store)
+                    entries.extend(part)
+                else:
+                    rendered = data.iter_lines(font, cache=self._line_cache)
+                    while True:
+                        with metrics.stage('render_lines'):
+                            batch = list(islice(rendered, DEDUP_BATCH))
+                        if not batch:
+                            break
+                        with metrics.stage('dedup_tiles'):
+                            (store, part) = data.dedup_tiles(font, batch, store)
+                        entries.extend(part)
+
+                counts.append(len(entries) - start)
+        except BaseException:
+            for temp, output_map in pending:
+                if os.path.exists(temp):
+                    os.remove(temp)
+            raise
+        for temp, output_map in pending:
+            os.replace(temp, output_map)
         if output: print('Text rendered.')
 
         if output: print("Generating tilemap...", end='')
-        (compressed, raw, map_index, indexes, total, unique) = script.generate_tilemap(font, lines)
+        if store is None:
+            store = TileStore(font.height, font.width)
+        with metrics.stage('dedup_tiles'):
+            tiles = (store, entries)
+            if script.tile_flips:
+                tiles = orient_tiles(*tiles)
+            unique = len(tiles[0])
+
+        if script.tile_dictionary is not None:
+            with metrics.stage('allocate_tiles'):
+                if os.path.exists(output_dict):
+                    previous = load_tile_dictionary(output_dict, font)
+                else:
+                    previous = tiles[0].tiles[:0]
+                (bank, entries, allocated) = allocate_tiles(
+                    previous, *tiles, reclaim=script.reclaim_tiles, flips=script.tile_flips
+                )
+                tiles = (bank, entries)
+
+        (compressed, entries) = tiles
+        # The raw tile ids of each script, and its tilemap entries if they are
+        # still to be written.
+        raws = [ids for ids, lines in streamed]
+        indexes = [None for ids, lines in streamed]
+        start = 0
+        with metrics.stage('build_tilemap'):
+            for data, count in zip(scripts, counts):
+                tilemap = data.build_tilemap(font, compressed, entries[start:start + count])
+                raws.append(tilemap[1])
+                indexes.append(tilemap[3])
+                start += count
+
+        raw = np.concatenate(raws)
+        total = len(raw)
+        slots = len(compressed)
+        metrics.count(lines=len(entries) + sum(lines for ids, lines in streamed), tiles=total,
+                      unique_tiles=unique, slots=slots, tile_store_bytes=compressed.nbytes)
         if output: print("{} tiles generated, {} unique.".format(total, unique))
+        if output: print("Tile store uses {:.1f} KiB.".format(compressed.nbytes / 1024))
+        if output and script.tile_flips:
+            print("{} tiles saved by flipping.".format(len(np.unique(raw)) - unique))
+        if output and script.tile_dictionary is not None:
+            print("Tile bank has {} slots: {} tiles kept, {} added, {} reclaimed.".format(slots, *allocated))
 
-        if output: print('Writing compressed tiles...', end='')
-        script.render_tiles_to_file(font, compressed, output_comp)
-        if output: print('done.')
+        # Pages of paged tile sheets, by the position of their manifest in outputs.
+        pages = {}
+        if script.write_images:
+            if output: print('Writing compressed tiles...', end='')
+            with metrics.stage('write_compressed'):
+                pages[0] = script.render_tiles_to_file(font, compressed, output_comp)
+            if output: print('done.')
 
-        if output: print('Writing raw tiles...', end='')
-        script.render_tiles_to_file(font, raw, output_raw)
-        if output: print('done.')
+            if output: print('Writing raw tiles...', end='')
+            with metrics.stage('write_raw'):
+                for i, (data, ids, (output_raw, output_map)) in enumerate(zip(scripts, raws, maps)):
+                    pages[1 + 2 * i] = data.render_tiles_to_file(font, compressed, output_raw, ids=ids)
+            if output: print('done.')
+            if script.page_tiles > 0:
+                metrics.count(pages=sum(len(files) for files in pages.values()))
 
-        if output: print('Writing map index...', end='')
-        with open(output_map, mode='wt') as f:
-            for text, index in indexes:
-                if script.output_format == 'thingy':
-                    f.write('{}={}\n'.format(index, text))
-                else:
-                    f.write('{} = {}\n'.format(text, index))
-        if output: print('done.')
+        if script.binary_format is not None:
+            if output: print('Writing {} tiles...'.format(script.binary_format), end='')
+            with metrics.stage('write_binary'):
+                script.render_tiles_to_binary(font, compressed, output_bin)
+            if output: print('done.')
+
+        if not streaming:
+            if output: print('Writing map index...', end='')
+            with metrics.stage('write_tilemap'):
+                for data, index, (output_raw, output_map) in zip(scripts, indexes, maps):
+                    with open(output_map, mode='wt') as f:
+                        self._write_tilemap(f, data, index)
+            if output: print('done.')
+
+        if script.tile_dictionary is not None:
+            if output: print('Writing tile dictionary...', end='')
+            with metrics.stage('write_dictionary'):
+                save_tile_dictionary(output_dict, font, compressed)
+            if output: print('done.')
+
+        if key is not None:
+            with metrics.stage('cache_store'):
+                self._cache.store(label, key, outputs, {i: files for i, files in pages.items() if files})
+        metrics.count(line_cache_hits=self._line_cache.hits - hits,
+                      line_cache_misses=self._line_cache.misses - misses)
 
         if output:
-            print()
-            print('Raw tiles:   ', output_raw)
-            print('Compressed:  ', output_comp)
+            self._report(script, outputs, maps)
+
+    def _stream_tilemap(self, data, font, store, filename):
+        """Renders and deduplicates a script a batch of lines at a time,
+        writing the tilemap entries of each batch to filename as it goes, so
+        that only the raw tile ids are kept. Returns the store, the raw tile
+        ids and the number of lines."""
+        metrics = self._metrics
+        rendered = data.iter_lines(font, cache=self._line_cache)
+        names = []
+        raws = []
+        lines = 0
+
+        with open(filename, mode='wt') as f:
+            while True:
+                with metrics.stage('render_lines'):
+                    batch = list(islice(rendered, DEDUP_BATCH))
+                if not batch:
+                    break
+                with metrics.stage('dedup_tiles'):
+                    (store, part) = data.dedup_tiles(font, batch, store)
+                with metrics.stage('write_tilemap'):
+                    self._write_tilemap(f, data, data.tilemap_entries(data.index_names(names, len(store)), part))
+                if part:
+                    raws.append(np.concatenate([ids for text, ids in part]))
+                lines += len(part)
+
+        raw = np.concatenate(raws) if raws else np.empty(0, dtype=np.int32)
+
+        return store, raw, lines
+
+    def _write_tilemap(self, f, data, entries):
+        for text, index in entries:
+            if data.output_format == 'thingy':
+                f.write('{}={}\n'.format(index, text))
+            else:
+                f.write('{} = {}\n'.format(text, index))
+
+    def _report(self, script, outputs, maps):
+        print()
+        if script.write_images:
+            for output_raw, output_map in maps:
+                print('Raw tiles:   ', script.sheet_filename(output_raw))
+            print('Compressed:  ', outputs[0])
+        if script.binary_format is not None:
+            print('Binary:      ', outputs[-1])
+        for output_raw, output_map in maps:
             print('Tile<->text: ', output_map)
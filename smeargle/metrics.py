@@ -0,0 +1,157 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import cProfile
+import json
+import os
+import re
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _max_rss(children=False):
+    """Returns the peak resident set size in KiB, where the platform reports it."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+
+
+class Metrics:
+    """Collects timings, memory use and counts for each target a Game renders.
+
+    A target's record holds the wall-clock and CPU time of each stage of
+    rendering it, in order, along with tile counts and cache statistics.
+    With memory set, tracemalloc follows Python and NumPy allocations, and
+    each stage also records the peak memory allocated while it ran; this
+    slows rendering down noticeably. With profile set to a directory, each
+    target is run under cProfile and its statistics are dumped there, named
+    after the target, for pstats or snakeviz.
+
+    A disabled instance records nothing and costs next to nothing, so Game
+    always has one.
+    """
+
+    def __init__(self, enabled=True, memory=True, profile=None):
+        self._enabled = enabled
+        self._memory = enabled and memory
+        self._profile = profile if enabled else None
+        self._record = None
+        self._started = time.perf_counter()
+        self.targets = {}
+
+        if self._memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._profile is not None:
+            os.makedirs(self._profile, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @property
+    def memory(self):
+        return self._memory
+
+    @property
+    def profile(self):
+        return self._profile
+
+    @contextmanager
+    def target(self, name):
+        """Records everything done within the block under a target's name."""
+        if not self._enabled:
+            yield None
+            return
+
+        record = {'wall_s': 0.0, 'cpu_s': 0.0, 'stages': {}, 'counts': {}}
+        self._record = record
+        profiler = cProfile.Profile() if self._profile is not None else None
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                filename = re.sub(r'[^\w.-]+', '_', name).strip('_') + '.prof'
+                record['profile'] = os.path.join(self._profile, filename)
+                profiler.dump_stats(record['profile'])
+
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+            if self._memory:
+                record['peak_bytes'] = max([stage.get('peak_bytes', 0) for stage in record['stages'].values()],
+                                           default=0)
+            self.targets[name] = record
+            self._record = None
+
+    def stage(self, name):
+        """Times the block as a stage of the current target. A stage entered
+        more than once accumulates."""
+        if self._record is None:
+            return nullcontext()
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name):
+        stage = self._record['stages'].setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0})
+        if self._memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        try:
+            yield
+        finally:
+            stage['wall_s'] += time.perf_counter() - wall
+            stage['cpu_s'] += time.process_time() - cpu
+            if self._memory:
+                peak = tracemalloc.get_traced_memory()[1] - base
+                stage['peak_bytes'] = max(stage.get('peak_bytes', 0), peak)
+
+    def count(self, **counts):
+        """Sets counts, such as of tiles, for the current target."""
+        if self._record is not None:
+            self._record['counts'].update(counts)
+
+    def merge(self, targets):
+        """Adds records made by another instance, such as in a worker process."""
+        self.targets.update(targets)
+
+    def summary(self):
+        """Returns every record, with totals for the whole run."""
+        return {
+            'wall_s': time.perf_counter() - self._started,
+            'max_rss_kib': _max_rss(),
+            'children_max_rss_kib': _max_rss(children=True),
+            'targets': self.targets,
+        }
+
+    def save(self, filename):
+        with open(filename, mode='w') as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write('\n')
+
+
+__all__ = ['Metrics']
@@ -0,0 +1,105 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import io
+import multiprocessing
+from contextlib import redirect_stdout
+
+from smeargle.game import Game
+from smeargle.metrics import Metrics
+
+# Each worker process loads the game, and with it the backend, exactly once.
+_game = None
+
+
+def _init(filename, backend, cache=None, line_cache=16384, font_cache=True, metrics=None):
+    global _game
+    if metrics is not None:
+        (memory, profile) = metrics
+        metrics = Metrics(memory=memory, profile=profile)
+    _game = Game(filename, backend=backend, cache=cache, line_cache=line_cache, font_cache=font_cache,
+                 metrics=metrics)
+
+
+def _render(args):
+    (script, render_path) = args
+    log = io.StringIO()
+
+    with redirect_stdout(log):
+        _game.render(script, render_path, output=True)
+
+    record = _game.metrics.targets.pop(script, None)
+    return script, log.getvalue(), record
+
+
+def _tile_shard(args):
+    (script, shard, shards) = args
+    log = io.StringIO()
+
+    with redirect_stdout(log):
+        part = _game.tile_shard(script, shard, shards)
+
+    return part, log.getvalue()
+
+
+def render_scripts(filename, render_path, scripts, jobs, backend='qt', cache=None, line_cache=16384,
+                   font_cache=True, metrics=None):
+    """Renders scripts across a pool of worker processes.
+
+    Yields (script, console output) pairs in the order the scripts were
+    given, as soon as each one is finished, so that the parent can print
+    them exactly as a serial run would have. If metrics is an enabled
+    Metrics, the workers record their scripts the same way, and the records
+    are added to it.
+    """
+    if metrics is not None and metrics.enabled:
+        options = (metrics.memory, metrics.profile)
+    else:
+        options = None
+
+    # Qt does not survive fork(), so always start workers from scratch.
+    context = multiprocessing.get_context('spawn')
+
+    initargs = (filename, backend, cache, line_cache, font_cache, options)
+    with context.Pool(jobs, initializer=_init, initargs=initargs) as pool:
+        work = [(script, render_path) for script in scripts]
+        for (script, log, record) in pool.imap(_render, work):
+            if record is not None:
+                metrics.merge({script: record})
+            yield script, log
+
+
+def render_sharded(game, filename, render_path, shards, jobs, backend='qt', line_cache=16384, font_cache=True):
+    """Renders each script of a game in turn, splitting it into shards.
+
+    The shards of a script are rendered and deduplicated across a pool of
+    worker processes, then merged and written out by the parent. Yields
+    (script, console output) pairs like render_scripts.
+    """
+    context = multiprocessing.get_context('spawn')
+
+    with context.Pool(jobs, initializer=_init, initargs=(filename, backend, None, line_cache, font_cache)) as pool:
+        def shard_map(script, shards):
+            return pool.map(_tile_shard, [(script, shard, shards) for shard in range(shards)])
+
+        for script in game.targets:
+            log = io.StringIO()
+
+            with redirect_stdout(log):
+                game.render(script, render_path, output=True, shards=shards, shard_map=shard_map)
+
+            yield script, log.getvalue()
+
+
+__all__ = ['render_scripts', 'render_sharded']
@@ -0,0 +1,456 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""A small PNG codec built on zlib and NumPy, used by the array backend."""
+
+import struct
+import zlib
+
+import numpy as np
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Samples per pixel for each PNG colour type.
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Number of scanlines decompressed and unfiltered at a time when decoding,
+# at most; fewer are taken if they would hold more than 4 MiB.
+UNFILTER_ROWS = 1024
+
+# Roughly how many bytes the per-byte loop of _unfilter_row undoes in the
+# time _unfilter_diagonals takes for one diagonal.
+DIAGONAL_COST = 64
+
+
+def _chunks(f):
+    if f.read(8) != SIGNATURE:
+        raise ValueError('not a PNG file')
+
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError('truncated PNG file')
+        (length, kind) = struct.unpack('>I4s', header)
+        data = f.read(length)
+        (crc,) = struct.unpack('>I', f.read(4))
+        if zlib.crc32(kind + data) != crc:
+            raise ValueError('corrupt PNG chunk: {}'.format(kind))
+
+        yield kind, data
+
+        if kind == b'IEND':
+            break
+
+
+def _unfilter_row(kind, row, prev, bpp):
+    """Reverses the filter of a single scanline, returning the new row."""
+    if kind == 0:
+        pass
+    elif kind == 1:
+        row = row.reshape(-1, bpp).cumsum(axis=0, dtype=np.uint8).ravel()
+    elif kind == 2:
+        row = row + prev
+    elif kind == 3:
+        (row, prev) = (bytearray(row.tobytes()), prev.tobytes())
+        for i in range(len(row)):
+            left = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff
+        row = np.frombuffer(row, dtype=np.uint8)
+    elif kind == 4:
+        (row, prev) = (bytearray(row.tobytes()), prev.tobytes())
+        for i in range(len(row)):
+            a = row[i - bpp] if i >= bpp else 0
+            b = prev[i]
+            c = prev[i - bpp] if i >= bpp else 0
+            p = a + b - c
+            pa = abs(p - a)
+            pb = abs(p - b)
+            pc = abs(p - c)
+            if pa <= pb and pa <= pc:
+                row[i] = (row[i] + a) & 0xff
+            elif pb <= pc:
+                row[i] = (row[i] + b) & 0xff
+            else:
+                row[i] = (row[i] + c) & 0xff
+        row = np.frombuffer(row, dtype=np.uint8)
+
+    return row
+
+
+def _unfilter_diagonals(kinds, rows, prev, bpp):
+    """Reverses the filters of consecutive scanlines of any type at once.
+
+    Each pixel depends only on the reconstructed pixels to its left, above
+    and above left, so every pixel on an anti-diagonal of the rows can be
+    reconstructed together. The rows are skewed so that each diagonal is a
+    contiguous row of its own, computed from the two before it.
+    """
+    (n, stride) = rows.shape
+    width = stride // bpp
+
+    # Pixel (r, x) of the zero-padded rows, with prev as row 0, goes to (r + x, r).
+    r = np.arange(n + 1, dtype=np.int32)[:, None]
+    x = np.arange(width + 1, dtype=np.int32)[None, :]
+    padded = np.zeros((n + 1, width + 1, bpp), dtype=np.int16)
+    padded[0, 1:] = prev.reshape(width, bpp)
+    padded[1:, 1:] = rows.reshape(n, width, bpp)
+    filtered = np.zeros((n + width + 1, n + 1, bpp), dtype=np.int16)
+    filtered[r + x, r] = padded
+    padded[1:] = 0
+    rec = np.zeros_like(filtered)
+    rec[r + x, r] = padded
+
+    # With one filter type, predictions are made in place; otherwise each
+    # type's is made and every pixel takes its own row's.
+    present = set(np.unique(kinds).tolist())
+    single = len(present) == 1
+    offsets = kinds.astype(np.intp) * n
+    pixels = np.arange(n)
+    predicted = np.zeros((5, n, bpp), dtype=np.int16)
+    (bc, ac, pa, pb, pc) = np.empty((5, n, bpp), dtype=np.int16)
+    (near, nearest) = np.empty((2, n, bpp), dtype=bool)
+
+    for d in range(2, n + width + 1):
+        (lo, hi) = (max(1, d - width), min(n, d - 1) + 1)
+        m = hi - lo
+        a = rec[d - 1, lo:hi]
+        b = rec[d - 1, lo - 1:hi - 1]
+        c = rec[d - 2, lo - 1:hi - 1]
+        out = rec[d, lo:hi]
+        pred = {kind: out if single else predicted[kind, :m] for kind in present}
+
+        if 1 in present:
+            pred[1][...] = a
+        if 2 in present:
+            pred[2][...] = b
+        if 3 in present:
+            np.add(a, b, out=pred[3])
+            pred[3] >>= 1
+        if 4 in present:
+            np.subtract(b, c, out=bc[:m])
+            np.subtract(a, c, out=ac[:m])
+            np.abs(bc[:m], out=pa[:m])
+            np.abs(ac[:m], out=pb[:m])
+            np.add(ac[:m], bc[:m], out=pc[:m])
+            np.abs(pc[:m], out=pc[:m])
+            np.less_equal(pb[:m], pc[:m], out=near[:m])
+            np.less_equal(pa[:m], pb[:m], out=nearest[:m])
+            nearest[:m] &= pa[:m] <= pc[:m]
+            np.copyto(pred[4], c)
+            np.copyto(pred[4], b, where=near[:m])
+            np.copyto(pred[4], a, where=nearest[:m])
+
+        if not single:
+            np.take(predicted.reshape(5 * n, bpp), offsets[lo - 1:hi - 1] + pixels[:m], axis=0, out=out)
+        out += filtered[d, lo:hi]
+        out &= 0xff
+
+    return rec[r[1:] + x[:, 1:], r[1:]].reshape(n, stride).astype(np.uint8)
+
+
+def _unfilter(kinds, rows, prev, bpp):
+    """Reverses the filters of consecutive scanlines, given as an (n, stride)
+    array, returning the new rows.
+
+    None, Sub and Up are undone a row at a time with NumPy. Average and
+    Paeth depend on the pixel to the left, so a long enough run of rows
+    using them is undone a diagonal at a time; see _unfilter_diagonals.
+    """
+    if len(kinds) and kinds.max() > 4:
+        raise ValueError('unknown PNG filter type: {}'.format(kinds.max()))
+
+    out = np.empty_like(rows)
+    slow = np.flatnonzero(kinds >= 3)
+    i = 0
+
+    while i < len(rows):
+        span = slow[-1] + 1 - i if len(slow) and slow[0] == i else 0
+        if span * rows.shape[1] >= DIAGONAL_COST * (span + rows.shape[1] // bpp):
+            out[i:i + span] = _unfilter_diagonals(kinds[i:i + span], rows[i:i + span], prev, bpp)
+            i += span
+        else:
+            out[i] = _unfilter_row(kinds[i], rows[i], prev, bpp)
+            i += 1
+        prev = out[i - 1]
+        slow = slow[slow >= i]
+
+    return out
+
+
+def _unpack(rows, width, depth, channels):
+    """Expands unfiltered scanlines into an array of samples."""
+    rows = np.asarray(rows, dtype=np.uint8)
+
+    if depth == 8:
+        samples = rows[:, :width * channels]
+    elif depth == 16:
+        samples = rows[:, :width * channels * 2:2]
+    else:
+        bits = np.unpackbits(rows, axis=1)[:, :width * depth]
+        bits = bits.reshape(len(rows), width, depth)
+        weights = 1 << np.arange(depth - 1, -1, -1, dtype=np.uint8)
+        samples = (bits * weights).sum(axis=2, dtype=np.uint8)
+
+    return samples.reshape(len(rows), width, channels)
+
+
+class Reader:
+    """Decodes a PNG file a band of scanlines at a time.
+
+    Only the compressed data for the band being decoded is held in memory,
+    so images of any height can be processed in constant space.
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, mode='rb')
+        self._chunks = _chunks(self._file)
+        self._first = None
+        self._trns = False
+        self.palette = None
+
+        for kind, data in self._chunks:
+            if kind == b'IHDR':
+                (self.width, self.height, self._depth, self._color, _, _, interlace) = \
+                    struct.unpack('>IIBBBBB', data)
+            elif kind == b'PLTE':
+                self.palette = [tuple(data[i:i + 3]) for i in range(0, len(data), 3)]
+            elif kind == b'tRNS':
+                self._trns = True
+            elif kind == b'IDAT':
+                self._first = data
+                break
+
+        if self._color not in CHANNELS:
+            raise ValueError('unsupported PNG colour type: {}'.format(self._color))
+        if interlace:
+            raise ValueError('interlaced PNGs are not supported')
+
+        self._channels = CHANNELS[self._color]
+        self._stride = (self.width * self._depth * self._channels + 7) // 8
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def indexed(self):
+        return self._color == 3
+
+    @property
+    def transparent(self):
+        """Whether the image has an alpha channel or a tRNS chunk."""
+        return self._color in (4, 6) or self._trns
+
+    def _idat(self):
+        if self._first is not None:
+            yield self._first
+
+        for kind, data in self._chunks:
+            if kind == b'IDAT':
+                yield data
+
+    def _scanlines(self):
+        """Yields each scanline, decompressed and unfiltered. Scanlines are
+        unfiltered up to UNFILTER_ROWS at a time."""
+        bpp = max(1, self._depth * self._channels // 8)
+        size = self._stride + 1
+        group = max(1, min(UNFILTER_ROWS, (1 << 22) // size))
+        decompressor = zlib.decompressobj()
+        buf = bytearray()
+        prev = np.zeros(self._stride, dtype=np.uint8)
+        count = 0
+
+        for data in self._idat():
+            while data and count < self.height:
+                buf += decompressor.decompress(data, 1 << 16)
+                data = decompressor.unconsumed_tail
+
+                while count < self.height and len(buf) >= size * min(group, self.height - count):
+                    n = min(group, self.height - count)
+                    rows = np.frombuffer(bytes(buf[:n * size]), dtype=np.uint8).reshape(n, size)
+                    del buf[:n * size]
+                    rows = _unfilter(rows[:, 0], rows[:, 1:], prev, bpp)
+                    yield from rows
+                    prev = rows[-1]
+                    count += n
+
+        if count < self.height:
+            raise ValueError('truncated PNG image data')
+
+    def bands(self, rows):
+        """Yields the image in bands of the given number of rows.
+
+        Indexed images yield 2D arrays of palette indices; every other colour
+        type yields (rows, w, 3) RGB arrays. The last band may be shorter.
+        """
+        band = []
+
+        for row in self._scanlines():
+            band.append(row)
+            if len(band) == rows:
+                yield self._samples(band)
+                band = []
+
+        if band:
+            yield self._samples(band)
+
+    def _samples(self, rows):
+        samples = _unpack(rows, self.width, self._depth, self._channels)
+
+        if self._color == 3:
+            return samples[:, :, 0]
+        if self._depth < 8:
+            samples = samples * (255 // ((1 << self._depth) - 1))
+        if self._color in (0, 4):
+            return np.repeat(samples[:, :, :1], 3, axis=2)
+
+        return samples[:, :, :3]
+
+
+def read(filename):
+    """Reads a PNG file.
+
+    Indexed images return a 2D array of palette indices and the palette as a
+    list of (r, g, b) tuples. Every other colour type returns an (h, w, 3)
+    RGB array and None. Transparency is ignored.
+    """
+    with Reader(filename) as reader:
+        bands = list(reader.bands(max(reader.height, 1)))
+        palette = reader.palette if reader.indexed else None
+
+    if bands:
+        return bands[0], palette
+    if reader.indexed:
+        return np.zeros((0, reader.width), dtype=np.uint8), palette
+    return np.zeros((0, reader.width, 3), dtype=np.uint8), None
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def depth_for(palette):
+    """Returns the smallest PNG bit depth able to index the palette."""
+    for depth in (1, 2, 4):
+        if len(palette) <= 1 << depth:
+            return depth
+    return 8
+
+
+def pack(pixels, depth):
+    """Packs a 2D array of indices into PNG scanlines of the given depth."""
+    if depth == 8:
+        return pixels.astype(np.uint8)
+
+    per_byte = 8 // depth
+    (height, width) = pixels.shape
+    padded = np.zeros((height, -(-width // per_byte) * per_byte), dtype=np.uint8)
+    padded[:, :width] = pixels
+    padded = padded.reshape(height, -1, per_byte)
+    shifts = np.arange(8 - depth, -1, -depth, dtype=np.uint8)
+
+    return np.bitwise_or.reduce(padded << shifts, axis=2).astype(np.uint8)
+
+
+def _scanlines(pixels, depth):
+    """Packs a 2D array of indices into unfiltered PNG scanlines."""
+    rows = pack(pixels, depth)
+    data = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    data[:, 1:] = rows
+
+    return data.tobytes()
+
+
+def header(width, height, palette):
+    """Returns the signature, IHDR and PLTE chunks of an indexed PNG."""
+    depth = depth_for(palette)
+    plte = b''.join(bytes(color) for color in palette)
+
+    return (
+        SIGNATURE +
+        _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, depth, 3, 0, 0, 0)) +
+        _chunk(b'PLTE', plte)
+    )
+
+
+class Writer:
+    """Encodes an indexed PNG a band of rows at a time.
+
+    Rows are compressed and written out as they are given, so the whole
+    image never has to be held in memory.
+    """
+
+    def __init__(self, filename, width, height, palette):
+        self._file = open(filename, mode='wb')
+        self._depth = depth_for(palette)
+        self._compressor = zlib.compressobj(6)
+        self._rows = 0
+        self.width = width
+        self.height = height
+
+        self._file.write(header(width, height, palette))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, pixels):
+        """Appends a 2D array of palette indices to the image."""
+        if pixels.shape[1] != self.width:
+            raise ValueError('rows must be {} pixels wide'.format(self.width))
+
+        self._rows += pixels.shape[0]
+        self._idat(self._compressor.compress(_scanlines(pixels, self._depth)))
+
+    def _idat(self, data):
+        if data:
+            self._file.write(_chunk(b'IDAT', data))
+
+    def close(self):
+        if self._file.closed:
+            return
+
+        try:
+            if self._rows != self.height:
+                raise ValueError('expected {} rows, got {}'.format(self.height, self._rows))
+            self._idat(self._compressor.flush())
+            self._file.write(_chunk(b'IEND', b''))
+        finally:
+            self._file.close()
+
+
+def write(filename, pixels, palette):
+    """Writes a 2D array of palette indices as an indexed PNG."""
+    (height, width) = pixels.shape
+
+    with Writer(filename, width, height, palette) as writer:
+        writer.write(pixels)
+
+
+def encode(pixels, palette):
+    """Returns a 2D array of palette indices encoded as an indexed PNG."""
+    (height, width) = pixels.shape
+    data = zlib.compress(_scanlines(pixels, depth_for(palette)), 6)
+
+    return header(width, height, palette) + _chunk(b'IDAT', data) + _chunk(b'IEND', b'')
+
+
+__all__ = ['Reader', 'Writer', 'encode', 'read', 'write']
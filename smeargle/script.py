@@ -12,17 +12,168 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
 # IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from math import floor, ceil
 
-from PyQt5.QtGui import QPainter, QImage
+import numpy as np
 
+from smeargle.compositor import BitmaskCompositor
 from smeargle.font import Font
+from smeargle.formats import encode
+from smeargle.tiles import (
+    TileStore, FLIP_H, FLIP_SHIFT, FLIP_V, SLOT_MASK, canonical_tiles, flip_tiles, remap_ids, tile_digests
+)
+
+# Number of tiles laid out at a time when streaming a tile sheet to disk,
+# rounded down to whole rows of the sheet.
+SHEET_BAND = 1024
+
+# Number of lines deduplicated at a time.
+DEDUP_BATCH = 256
 
 def get_or_default(d, key, default):
     if key not in d:
         return default
     return d[key]
 
+def page_filename(filename, page, pages):
+    """Returns the filename of one page of a paged tile sheet."""
+    (base, ext) = os.path.splitext(filename)
+    digits = max(3, len(str(pages - 1)))
+
+    return '{}_{:0{}d}{}'.format(base, page, digits, ext)
+
+def manifest_filename(filename):
+    """Returns the filename of the manifest of a paged tile sheet."""
+    return os.path.splitext(filename)[0] + '.json'
+
+def tile_keys(tiles):
+    """Returns the pixel data of each tile in an (n, height, width) array as bytes."""
+    size = tiles[0].size if len(tiles) else 0
+    keys = np.ascontiguousarray(tiles).reshape(len(tiles), size)
+
+    return keys.view(np.dtype((np.void, size))).ravel().tolist()
+
+def merge_tiles(parts, store=None):
+    """Merges the results of Script.dedup_tiles over consecutive shards of a script.
+
+    Tiles are matched by content and numbered in order of first occurrence,
+    so the result is exactly what deduplicating the whole script at once
+    would have produced. If a TileStore is given, tiles are added to it.
+    """
+    if store is None:
+        store = TileStore(*parts[0][0].shape)
+    entries = []
+
+    for part, part_entries in parts:
+        remap = store.add(part.tiles)
+        entries.extend((text, remap_ids(remap, ids)) for text, ids in part_entries)
+
+    return store, entries
+
+def orient_tiles(tiles, entries):
+    """Turns each tile of a flip-aware dedup_tiles or merge_tiles result to
+    match its first use, so that only tiles which need flipping are flipped."""
+    if not entries:
+        return tiles, entries
+
+    ids = np.concatenate([ids for text, ids in entries])
+    (slots, first) = np.unique(ids & SLOT_MASK, return_index=True)
+    flips = np.zeros(len(tiles), dtype=np.int32)
+    flips[slots] = ids[first] >> FLIP_SHIFT
+
+    store = TileStore.from_tiles(flip_tiles(tiles.tiles, flips))
+    same = np.arange(len(tiles), dtype=np.int32)
+
+    return store, [(text, remap_ids(same, ids, flips)) for text, ids in entries]
+
+def load_tile_dictionary(filename, font):
+    """Loads a tile bank saved by save_tile_dictionary as an (n, height, width) array."""
+    with open(filename, mode='rt') as f:
+        data = json.load(f)
+
+    if (data['width'], data['height']) != (font.width, font.height):
+        raise ValueError('tile dictionary {} does not match the font tile size'.format(filename))
+
+    bank = np.zeros((len(data['tiles']), font.height, font.width), dtype=np.uint8)
+    for key, slot in data['tiles'].items():
+        bank[slot] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8).reshape(font.height, font.width)
+
+    return bank
+
+def save_tile_dictionary(filename, font, bank):
+    """Saves a TileStore as a mapping of tile pixel data, in hex, to slot."""
+    data = {
+        'width': font.width,
+        'height': font.height,
+        'tiles': {key.hex(): slot for slot, key in enumerate(tile_keys(bank.tiles))},
+    }
+
+    with open(filename, mode='wt') as f:
+        json.dump(data, f, indent=0)
+
+def allocate_tiles(previous, tiles, entries, reclaim=False, flips=False):
+    """Assigns deduplicated tiles to the slots of an existing tile bank.
+
+    Tiles already in the previous bank keep their slots, and new tiles are
+    appended to it. With flips, a tile also keeps the slot of any flip of
+    it. With reclaim, new tiles first fill the slots of tiles which are no
+    longer referenced, lowest slot first. Returns the new bank as a
+    TileStore, the entries renumbered by slot, and the number of tiles
+    kept, added and reclaimed.
+    """
+    bank = TileStore.from_tiles(previous)
+    found = bank.lookup(tiles.tiles)
+    flipped = np.zeros(len(tiles), dtype=np.int32)
+
+    if flips:
+        for flip in (FLIP_H, FLIP_V, FLIP_H | FLIP_V):
+            missing = np.flatnonzero(found < 0)
+            match = bank.lookup(flip_tiles(tiles.tiles[missing], np.full(len(missing), flip)))
+            found[missing] = match
+            flipped[missing[match >= 0]] = flip
+
+    slots = np.empty(len(tiles), dtype=np.int32)
+    (kept, added, reclaimed) = (0, 0, 0)
+
+    if reclaim:
+        free = sorted(set(range(len(bank))) - set(found.tolist()), reverse=True)
+    else:
+        free = []
+
+    for i, tile in enumerate(tiles.tiles):
+        if found[i] >= 0:
+            slots[i] = found[i]
+            kept += 1
+        elif free:
+            slots[i] = free.pop()
+            bank.replace(slots[i], tile)
+            reclaimed += 1
+        else:
+            slots[i] = bank.add(tile[np.newaxis])[0]
+            added += 1
+
+    entries = [(text, remap_ids(slots, ids, flipped)) for text, ids in entries]
+
+    return bank, entries, (kept, added, reclaimed)
+
+class FlippedNames(dict):
+    """Maps tile ids to tilemap indices with the script's flip bits set."""
+
+    def __init__(self, script, names):
+        super().__init__(enumerate(names))
+        self._script = script
+
+    def __missing__(self, id):
+        (h, v) = self._script._cfg['flip_bits']
+        flips = id >> FLIP_SHIFT
+        index = (id & SLOT_MASK) + (bool(flips & FLIP_H) << h) + (bool(flips & FLIP_V) << v)
+        self[id] = self._script.format_index(index)
+        return self[id]
+
 class Script:
     def __init__(self, filename, **kwargs):
         self._cfg = {
@@ -35,17 +186,41 @@ class Script:
             'deduped_fn':     get_or_default(kwargs, 'deduped_fn',         None),
             'tilemap_fn':     get_or_default(kwargs, 'tilemap_fn',         None),
             'little_endian':  get_or_default(kwargs, 'little_endian',      False),
+            'tile_dictionary': get_or_default(kwargs, 'tile_dictionary',   None),
+            'reclaim_tiles':  get_or_default(kwargs, 'reclaim_tiles',      False),
+            'binary_format':  get_or_default(kwargs, 'binary_format',      None),
+            'binary_fn':      get_or_default(kwargs, 'binary_fn',          None),
+            'write_images':   get_or_default(kwargs, 'write_images',       True),
+            'compositor':     get_or_default(kwargs, 'compositor',         'painter'),
+            'wrap_lines':     get_or_default(kwargs, 'wrap_lines',         False),
+            'tile_flips':     get_or_default(kwargs, 'tile_flips',         False),
+            'flip_bits':      get_or_default(kwargs, 'flip_bits',          [14, 15]),
+            'bank':           get_or_default(kwargs, 'bank',               None),
+            'page_tiles':     get_or_default(kwargs, 'page_tiles',         0),
+            'sheet_width':    get_or_default(kwargs, 'sheet_width',        16),
         }
+        self._bitmask = None
         mint = self._cfg['min_tiles']
         maxt = self._cfg['max_tiles']
 
         if mint > maxt and maxt != 0:
             raise ValueError('minimum tiles per line higher than maximum')
+        if self._cfg['sheet_width'] < 1:
+            raise ValueError('sheet width must be at least one tile')
+        if self._cfg['page_tiles'] < 0:
+            raise ValueError('tiles per page must not be negative')
 
-        with open(filename, mode='r', encoding='UTF-8') as f:
-            self._text = f.read().split('\n')
+        # The text is read as it is rendered; check now that it can be.
+        with open(filename, mode='r', encoding='UTF-8'):
+            self._filename = filename
 
-        self._painter = QPainter()
+    @property
+    def max_tiles(self):
+        return self._cfg['max_tiles']
+
+    @property
+    def min_tiles(self):
+        return self._cfg['min_tiles']
 
     @property
     def raw_fn(self):
@@ -59,6 +234,55 @@ class Script:
     def tilemap_fn(self):
         return self._cfg['tilemap_fn']
 
+    @property
+    def tile_dictionary(self):
+        return self._cfg['tile_dictionary']
+
+    @property
+    def reclaim_tiles(self):
+        return self._cfg['reclaim_tiles']
+
+    @property
+    def binary_format(self):
+        return self._cfg['binary_format']
+
+    @property
+    def binary_fn(self):
+        return self._cfg['binary_fn']
+
+    @property
+    def write_images(self):
+        return self._cfg['write_images']
+
+    @property
+    def bank(self):
+        return self._cfg['bank']
+
+    @property
+    def tile_flips(self):
+        return self._cfg['tile_flips']
+
+    @property
+    def page_tiles(self):
+        return self._cfg['page_tiles']
+
+    @property
+    def sheet_width(self):
+        return self._cfg['sheet_width']
+
+    def sheet_filename(self, filename):
+        """Returns the file which stands for a tile sheet among the outputs:
+        the sheet itself, or the manifest of its pages."""
+        return manifest_filename(filename) if self.page_tiles > 0 else filename
+
+    @property
+    def wrap_lines(self):
+        return self._cfg['wrap_lines']
+
+    @property
+    def compositor(self):
+        return self._cfg['compositor']
+
     @property
     def output_format(self):
         return self._cfg['output_format']
@@ -71,17 +295,90 @@ class Script:
     def tile_offset(self):
         return self._cfg['tile_offset']
     
-    def render_lines(self, font):
-        table = font.table
-        lines = []
+    def lines(self):
+        """Yields the lines of the script's text, reading the file as it goes."""
+        with open(self._filename, mode='r', encoding='UTF-8') as f:
+            for line in f:
+                yield line[:-1] if line.endswith('\n') else line
+
+    def shard(self, shard, shards):
+        """Yields one of several consecutive, roughly equal runs of the script's lines."""
+        size = ceil(sum(1 for line in self.lines()) / shards)
+
+        return islice(self.lines(), shard * size, (shard + 1) * size)
+
+    def wrap(self, font, line):
+        """Splits a line into pieces which each fit in max_tiles_per_line.
+
+        Lines are broken at the last space that fits, which is dropped, or
+        between glyphs if there is none. A piece fits if render_lines would
+        not drop any of its glyphs.
+        """
+        max_tiles = self._cfg['max_tiles'] * font.width
+        if max_tiles <= 0:
+            return [line]
+
+        ends = np.cumsum(font.measure(line)[0])
+        pieces = []
+        start = 0
+
+        while start < len(line):
+            base = ends[start - 1] if start > 0 else 0
+            end = int(np.searchsorted(ends, base + max_tiles, side='left'))
+            if end >= len(line):
+                pieces.append(line[start:])
+                break
+
+            end = max(end, start + 1)
+            space = line.rfind(' ', start + 1, end + 1)
+            if space > start:
+                pieces.append(line[start:space])
+                start = space + 1
+            else:
+                pieces.append(line[start:end])
+                start = end
+
+        return pieces
+
+    def render_lines(self, font, text=None, cache=None):
+        """Renders each non-empty line and slices it into tiles.
+
+        Returns a list of (text, image, length, lineno, tiles, digests) tuples;
+        see iter_lines.
+        """
+        return list(self.iter_lines(font, text, cache))
+
+    def iter_lines(self, font, text=None, cache=None):
+        """Renders each non-empty line and slices it into tiles, one at a time.
+
+        Yields a (text, image, length, lineno, tiles, digests) tuple for each
+        line, as it is read from the script, or from text if given. If a
+        LineCache is given, lines it already holds are not rendered again.
+        With wrap_lines, long lines are first split with wrap().
+        """
+        lineno = 0
         max_tiles = self._cfg['max_tiles'] * font.width
         min_tiles = self._cfg['min_tiles'] * font.width
 
-        for line in self._text:
+        if text is None:
+            text = self.lines()
+        if self.wrap_lines:
+            text = (piece for line in text for piece in self.wrap(font, line))
+
+        for line in text:
             if len(line) < 1:
                 continue
-            length = font.length(line)
-            length = ceil(length / font.width) * font.width
+
+            key = (font.filename, line, self._cfg['min_tiles'], self._cfg['max_tiles'])
+            entry = cache.get(key) if cache is not None else None
+
+            if entry is None:
+                (widths, indices) = font.measure(line)
+                ends = np.cumsum(widths)
+                full = ceil(int(ends[-1]) / font.width) * font.width
+            else:
+                full = entry[0]
+            length = full
 
             if max_tiles > 0:
                 if 0 < max_tiles < length:
@@ -99,131 +396,250 @@ class Script:
                         min_tiles - length
                     ))
                     length = min_tiles
-            image = QImage(length, font.height, QImage.Format_RGB32)
-            image.fill(font.palette[0])
-            pos = 0
 
-            self._painter.begin(image)
-            for glyph in line:
-                width = font.table[glyph]['width']
-                if pos + width >= max_tiles and max_tiles > 0:
-                    break
-                self._painter.drawImage(pos, 0, font.index(font.table[glyph]['index'] - 1))
+            if entry is None:
+                # A glyph is drawn only if it ends before max_tiles, as are all before it.
+                count = len(line)
+                if max_tiles > 0:
+                    count = int(np.searchsorted(ends, max_tiles, side='left'))
+                glyphs = list(zip((ends - widths)[:count].tolist(), (indices[:count] - 1).tolist()))
 
-                pos += width
-            self._painter.end()
+                if self.compositor == 'bitmask':
+                    image = self.bitmask(font).render_line(glyphs, length)
+                    tiles = self.slice_tiles(font, image)
+                else:
+                    image = font.backend.render_line(font, glyphs, length)
+                    tiles = self.slice_tiles(font, self.line_pixels(font, image))
+                entry = (full, image, tiles, tile_digests(tiles))
+
+                if cache is not None:
+                    cache.put(key, entry)
+
+            (_, image, tiles, digests) = entry
+            yield (line, image, length, lineno, tiles, digests)
+            lineno += 1
+
+    def format_index(self, index):
+        """Formats a tile index for the tilemap, honouring output options."""
+        index += self.tile_offset
+        upper_val = int(floor(index / 256))
+        lower_val = int(index % 256)
+
+        if upper_val > 0 or self.leading_zeroes is True:
+            if self._cfg['little_endian']:
+                temp = upper_val
+                upper_val = lower_val
+                lower_val = temp
+            if self.output_format == 'atlas':
+                return "<${:02x}><${:02x}>".format(upper_val, lower_val)
+            elif self.output_format == 'thingy':
+                return "{:02x}{:02x}".format(upper_val, lower_val)
+            else:
+                return '0x{:02x}{:02x}'.format(upper_val, lower_val)
+        else:
+            if self.output_format == 'atlas':
+                return "<${:02x}>".format(lower_val)
+            elif self.output_format == 'thingy':
+                return "{:02x}".format(lower_val)
+            else:
+                return '0x{:02x}'.format(index)
+
+    def bitmask(self, font):
+        """Returns the BitmaskCompositor for a font, creating it if needed."""
+        if self._bitmask is None or self._bitmask.font is not font:
+            self._bitmask = BitmaskCompositor(font)
+
+        return self._bitmask
+
+    def line_pixels(self, font, image):
+        """Converts a rendered line to a 2D array of palette indices."""
+        return font.backend.to_pixels(image, font.palette)
+
+    def slice_tiles(self, font, pixels):
+        """Slices a line of palette indices into an (n, height, width) array."""
+        count = int(pixels.shape[1] / font.width)
+        tiles = pixels[:, :count * font.width].reshape(font.height, count, font.width)
+
+        return np.ascontiguousarray(tiles.swapaxes(0, 1))
+
+    def dedup_tiles(self, font, lines, store=None):
+        """Slices rendered lines into tiles and deduplicates them.
+
+        lines may be any iterable, such as iter_lines, and is consumed a
+        batch at a time, so lines need not all be rendered at once. Returns
+        a TileStore of the unique tiles in order of first occurrence,
+        and for each line a (text, ids) pair, where ids are slots in the store.
+        With tile_flips, tiles which are flips of one another are stored once,
+        and the ids carry the flips needed to draw each tile. If a TileStore
+        is given, tiles are added to it instead of a new one.
+        """
+        if store is None:
+            store = TileStore(font.height, font.width)
+        entries = []
+
+        # Add many lines at once, so the store checks its digests in bulk.
+        lines = iter(lines)
+        while True:
+            batch = list(islice(lines, DEDUP_BATCH))
+            if not batch:
+                break
+
+            tiles = np.concatenate([line[4] for line in batch])
+
+            if self.tile_flips:
+                (tiles, digests, flips) = canonical_tiles(tiles)
+                ids = store.add(tiles, digests) | (flips << FLIP_SHIFT)
+            else:
+                ids = store.add(tiles, np.concatenate([line[5] for line in batch]))
+            splits = np.cumsum([len(line[4]) for line in batch])[:-1]
+            entries.extend(zip([line[0] for line in batch], np.split(ids, splits)))
 
-            lines.append((line, image, length, len(lines)))
+        return store, entries
 
-        return lines
+    def index_names(self, names, count):
+        """Extends a list of the tilemap index of each slot to count slots."""
+        names.extend(self.format_index(i) for i in range(len(names), count))
 
-    def generate_tilemap(self, font, lines):
-        tilemap = {}
-        raw_tiles = []
-        compressed_tiles = []
-        map_idx = {}
-        unique = total = 0
-        indexes = []
-
-        for line in lines:
-            (text, image, length, lineno) = line
-            tile_idx = []
-
-            # number of tiles in this line
-            count = int(length / font.width)
-
-            column = 0
-
-            while count > 0:
-                tile = image.copy(column, 0, font.width, font.height)
-                if len(font.palette) > 1:
-                    tile = tile.convertToFormat(QImage.Format_Indexed8, font.palette)
-                else:
-                    tile = tile.convertToFormat(QImage.Format_Indexed8)
-                data = bytearray()
-
-                for y in range(tile.height()):
-                    for x in range(tile.width()):
-                        data.append(tile.pixelIndex(x, y))
-
-                data = bytes(data)
-
-                if data not in tilemap.keys():
-                    tilemap[data] = tile
-                    compressed_tiles.append(tile)
-                    if self.output_format == 'atlas':
-                        index = unique + self.tile_offset
-                        upper_val = int(floor(index / 256))
-                        lower_val = int(index % 256)
-                        if upper_val > 0 or self.leading_zeroes is True:
-                            if self._cfg['little_endian']:
-                                temp = upper_val
-                                upper_val = lower_val
-                                lower_val = temp
-                            map_idx[data] = "<${:02x}><${:02x}>".format(upper_val, lower_val)
-                        else:
-                            map_idx[data] = "<${:02x}>".format(lower_val)
-                    elif self.output_format == 'thingy':
-                        index = unique + self.tile_offset
-                        upper_val = int(floor(index / 256))
-                        lower_val = int(index % 256)
-                        if upper_val > 0 or self.leading_zeroes is True:
-                            if self._cfg['little_endian']:
-                                temp = upper_val
-                                upper_val = lower_val
-                                lower_val = temp
-                            map_idx[data] = "{:02x}{:02x}".format(upper_val, lower_val)
-                        else:
-                            map_idx[data] = "{:02x}".format(lower_val)
-                    else:
-                        index = unique + self.tile_offset
-                        upper_val = int(floor(index / 256))
-                        lower_val = int(index % 256)
-                        if upper_val > 0 or self.leading_zeroes is True:
-                            if self._cfg['little_endian']:
-                                temp = upper_val
-                                upper_val = lower_val
-                                lower_val = temp
-                            map_idx[data] = '0x{:02x}{:02x}'.format(upper_val, lower_val)
-                        else:
-                            map_idx[data] = '0x{:02x}'.format(unique + self.tile_offset)
-                    unique += 1
-
-                raw_tiles.append(tile)
-                tile_idx.append(map_idx[data])
-                total += 1
-                column += font.width
-                count -= 1
-
-            if self.output_format is None:
-                indexes.append((text, ' '.join(tile_idx)))
-            else:
-                indexes.append((text, ''.join(tile_idx)))
-        return compressed_tiles, raw_tiles, map_idx, indexes, total, unique
+        return names
 
-    def render_tiles(self, font, tiles):
-        image = QImage(font.width * 16, ceil(len(tiles) / 16) * font.height, QImage.Format_RGB32)
-        image.fill(font.palette[0])
+    def tilemap_entries(self, names, entries):
+        """Yields the (text, index) pair of the tilemap for each (text, ids)
+        entry, given the tilemap index of each id."""
+        separator = ' ' if self.output_format is None else ''
 
-        (row, column) = (0, 0)
+        for text, ids in entries:
+            yield text, separator.join([names[i] for i in ids.tolist()])
 
-        self._painter.begin(image)
-        for tile in tiles:
-            self._painter.drawImage(column, row, tile)
+    def build_tilemap(self, font, tiles, entries):
+        """Builds the tilemap from the output of dedup_tiles or merge_tiles.
 
-            if column < (font.width * 15):
-                column += font.width
-            else:
-                column = 0
-                row += font.height
-        self._painter.end()
+        The raw tiles are returned as an array of ids in the TileStore
+        tiles, in script order, rather than as pixel data. The (text, index)
+        pairs of the tilemap are generated as they are iterated over, so
+        that they can be written out without all being held at once.
+        """
+        names = self.index_names([], len(tiles))
+        map_idx = dict(zip(tile_keys(tiles.tiles), names))
+
+        if self.tile_flips:
+            names = FlippedNames(self, names)
 
-        if len(font.palette) > 1:
-            return image.convertToFormat(QImage.Format_Indexed8, font.palette)
+        indexes = self.tilemap_entries(names, entries)
+
+        if entries:
+            raw_ids = np.concatenate([ids for text, ids in entries])
         else:
-            return image.convertToFormat(QImage.Format_Indexed8)
+            raw_ids = np.empty(0, dtype=np.int32)
+
+        return tiles, raw_ids, map_idx, indexes, len(raw_ids), len(tiles)
 
-    def render_tiles_to_file(self, font, tiles, filename):
-        self.render_tiles(font, tiles).save(filename, 'PNG')
+    def generate_tilemap(self, font, lines):
+        tiles = self.dedup_tiles(font, lines)
+        if self.tile_flips:
+            tiles = orient_tiles(*tiles)
+
+        return self.build_tilemap(font, *tiles)
+
+    def render_tiles(self, font, tiles):
+        """Lays out an (n, height, width) tile array in a sheet sheet_width tiles wide."""
+        width = self._cfg['sheet_width']
+        rows = ceil(len(tiles) / width)
+        sheet = np.zeros((rows * width, font.height, font.width), dtype=np.uint8)
+        sheet[:len(tiles)] = tiles
+        sheet = sheet.reshape(rows, width, font.height, font.width).swapaxes(1, 2)
+
+        return sheet.reshape(rows * font.height, width * font.width)
+
+    def render_tiles_to_file(self, font, tiles, filename, ids=None):
+        """Writes the tiles of a TileStore as a sheet sheet_width tiles wide.
+
+        If ids is given, the sheet holds the tiles in those slots instead,
+        built and written out a band of sheet rows at a time. With
+        page_tiles, the sheet is split into pages instead; see render_pages.
+        Returns the filenames of any pages written.
+        """
+        if self.page_tiles > 0:
+            return self.render_pages(font, tiles, filename, ids)
+
+        if ids is None:
+            font.backend.save(self.render_tiles(font, tiles.tiles), font.palette, filename)
+            return []
+
+        width = self._cfg['sheet_width']
+        band = max(1, SHEET_BAND // width) * width
+        rows = ceil(len(ids) / width)
+        bands = (
+            self.render_tiles(font, tiles.take(ids[start:start + band]))
+            for start in range(0, len(ids), band)
+        )
+        font.backend.save_bands(bands, width * font.width, rows * font.height, font.palette, filename)
+        return []
+
+    def render_pages(self, font, tiles, filename, ids=None):
+        """Writes a tile sheet as pages of page_tiles tiles each, and a manifest.
+
+        Pages are named after filename with their number appended, and are
+        written in parallel. The manifest, named after filename with a .json
+        extension, lists each page with the index of its first tile and its
+        number of tiles. Pages listed by a previous manifest which are no
+        longer written are removed. Returns the filenames of the pages.
+        """
+        count = len(tiles) if ids is None else len(ids)
+        size = self.page_tiles
+        pages = ceil(count / size)
+        filenames = [page_filename(filename, page, pages) for page in range(pages)]
+        manifest = manifest_filename(filename)
+
+        def write(page):
+            start = page * size
+            if ids is None:
+                page_tiles = tiles.tiles[start:start + size]
+            else:
+                page_tiles = tiles.take(ids[start:start + size])
+            font.backend.save(self.render_tiles(font, page_tiles), font.palette, filenames[page])
+
+        workers = min(pages, os.cpu_count() or 1)
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                list(pool.map(write, range(pages)))
+        else:
+            for page in range(pages):
+                write(page)
+
+        directory = os.path.dirname(manifest)
+        if os.path.exists(manifest):
+            with open(manifest, mode='rt') as f:
+                stale = {os.path.join(directory, page['filename']) for page in json.load(f).get('pages', [])}
+            for page in stale - set(filenames):
+                if os.path.exists(page):
+                    os.remove(page)
+
+        data = {
+            'tile_width': font.width,
+            'tile_height': font.height,
+            'sheet_width': self._cfg['sheet_width'],
+            'page_tiles': size,
+            'tiles': count,
+            'pages': [
+                {'filename': os.path.basename(page), 'first': i * size, 'count': min(size, count - i * size)}
+                for i, page in enumerate(filenames)
+            ],
+        }
+        with open(manifest, mode='wt') as f:
+            json.dump(data, f, indent=2)
+            f.write('\n')
+
+        return filenames
+
+    def render_tiles_to_binary(self, font, tiles, filename):
+        """Writes the tiles of a TileStore in binary_format, exactly as porygon.py
+        would encode them from the image written by render_tiles_to_file,
+        were it not split into pages."""
+        fmt = self.binary_format
+        if len(font.palette) > 2 ** int(fmt[-1]):
+            raise ValueError('font has too many colors for {}'.format(fmt))
+
+        with open(filename, mode='wb') as f:
+            f.write(encode(self.render_tiles(font, tiles.tiles), fmt))
 
 __all__ = ['Script']
@@ -0,0 +1,288 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import base64
+import io
+import json
+import threading
+import time
+from collections import deque
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import ceil
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from smeargle import png
+
+
+class PreviewError(ValueError):
+    """A preview request which cannot be answered, such as one naming an
+    unknown script or using a character its font lacks."""
+
+
+class Latencies:
+    """Counts requests and keeps the latencies of the most recent ones."""
+
+    def __init__(self, size=1024):
+        self._samples = deque(maxlen=size)
+        self.requests = 0
+        self.errors = 0
+
+    def add(self, seconds, error=False):
+        self._samples.append(seconds)
+        self.requests += 1
+        if error:
+            self.errors += 1
+
+    def summary(self):
+        """Returns the request counts and latency percentiles, in milliseconds."""
+        summary = {'requests': self.requests, 'errors': self.errors}
+        if self._samples:
+            samples = np.array(self._samples) * 1000
+            summary.update({
+                'mean_ms': round(float(samples.mean()), 3),
+                'p50_ms': round(float(np.percentile(samples, 50)), 3),
+                'p95_ms': round(float(np.percentile(samples, 95)), 3),
+                'max_ms': round(float(samples.max()), 3),
+            })
+
+        return summary
+
+
+class RenderService:
+    """Measures and renders single lines against a loaded game, for previews.
+
+    Requests may come from several threads at once. Fonts, their glyph
+    caches and the game's line cache are shared, so rendering itself is done
+    under a lock; parsing requests and encoding the results are not.
+    """
+
+    def __init__(self, game):
+        self._game = game
+        self._lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._latencies = {}
+        self._started = time.time()
+
+    @property
+    def game(self):
+        return self._game
+
+    def info(self):
+        return {
+            'name': self._game.name,
+            'fonts': list(self._game.fonts),
+            'scripts': list(self._game.scripts),
+        }
+
+    def preview(self, text, script, font=None, image=False):
+        """Fits text to a script's text box.
+
+        The script's line limits, wrapping and compositor apply; font names
+        a font to use instead of the script's own. Returns a dict with the
+        width in pixels and tiles of each line, whether it was truncated
+        and by how many pixels, and, if image is set, the lines drawn one
+        below another as a base64-encoded PNG.
+        """
+        if script not in self._game.scripts:
+            raise PreviewError('unknown script {!r}'.format(script))
+        if font is not None and font not in self._game.fonts:
+            raise PreviewError('unknown font {!r}'.format(font))
+
+        with self._lock:
+            (data, script_font) = self._game.script(script)
+            if font is not None:
+                script_font = self._game.font(font)
+            lines = self._fit(data, script_font, text)
+
+            rows = None
+            if image:
+                # Truncation is part of the result; keep render_lines' warnings off the console.
+                with redirect_stdout(io.StringIO()):
+                    rendered = data.render_lines(script_font, [line['text'] for line in lines],
+                                                 self._game.line_cache)
+                rows = [tiles for (line, img, length, lineno, tiles, digests) in rendered]
+
+        result = {
+            'width': max([line['width'] for line in lines], default=0),
+            'tiles': sum(line['tiles'] for line in lines),
+            'truncated': any(line['truncated'] for line in lines),
+            'lines': lines,
+        }
+        if rows is not None:
+            result['png'] = base64.b64encode(self._encode(script_font, rows)).decode('ascii')
+
+        return result
+
+    def _fit(self, data, font, text):
+        max_tiles = data.max_tiles * font.width
+        min_tiles = data.min_tiles * font.width
+        lines = []
+
+        for line in text.split('\n'):
+            try:
+                pieces = data.wrap(font, line) if data.wrap_lines else [line]
+            except KeyError as e:
+                raise PreviewError('character {} is not in the font'.format(e))
+
+            for piece in pieces:
+                if len(piece) < 1:
+                    continue
+                try:
+                    (widths, indices) = font.measure(piece)
+                except KeyError as e:
+                    raise PreviewError('character {} is not in the font'.format(e))
+
+                width = int(widths.sum())
+                length = ceil(width / font.width) * font.width
+                overflow = 0
+                if 0 < max_tiles < length:
+                    overflow = length - max_tiles
+                    length = max_tiles
+                if 0 < length < min_tiles:
+                    length = min_tiles
+
+                lines.append({
+                    'text': piece,
+                    'width': width,
+                    'tiles': length // font.width,
+                    'truncated': overflow > 0,
+                    'overflow': overflow,
+                })
+
+        return lines
+
+    def _encode(self, font, rows):
+        width = max([len(tiles) for tiles in rows], default=0) * font.width
+        pixels = np.zeros((len(rows) * font.height, width), dtype=np.uint8)
+
+        for i, tiles in enumerate(rows):
+            line = tiles.swapaxes(0, 1).reshape(font.height, -1)
+            pixels[i * font.height:(i + 1) * font.height, :line.shape[1]] = line
+
+        return png.encode(pixels, font.palette)
+
+    def record(self, endpoint, seconds, error=False):
+        with self._metrics_lock:
+            self._latencies.setdefault(endpoint, Latencies()).add(seconds, error)
+
+    def metrics(self):
+        """Returns request counts and latencies for each endpoint, and the
+        game's line cache statistics."""
+        with self._metrics_lock:
+            endpoints = {endpoint: latencies.summary() for endpoint, latencies in self._latencies.items()}
+
+        lines = self._game.line_cache
+        return {
+            'uptime_s': round(time.time() - self._started, 3),
+            'endpoints': endpoints,
+            'line_cache': {
+                'entries': len(lines),
+                'hits': lines.hits,
+                'misses': lines.misses,
+                'hit_rate': round(lines.hit_rate, 4),
+            },
+        }
+
+
+def _flag(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves a RenderService as JSON over HTTP.
+
+    GET  /          the game's name, fonts and scripts
+    GET  /preview   query parameters text, script, and optionally font and png
+    POST /preview   the same parameters as a JSON object
+    GET  /metrics   request counts and latencies
+    """
+
+    server_version = 'Smeargle'
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body, elapsed):
+        data = json.dumps(body).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Server-Timing', 'render;dur={:.3f}'.format(elapsed * 1000))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, params):
+        service = self.server.service
+        start = time.perf_counter()
+        endpoint = urlsplit(self.path).path
+        status = 200
+
+        try:
+            if endpoint == '/' and params is None:
+                body = service.info()
+            elif endpoint == '/metrics' and params is None:
+                body = service.metrics()
+            elif endpoint == '/preview':
+                if params is None:
+                    params = {k: v[-1] for k, v in parse_qs(urlsplit(self.path).query).items()}
+                if not isinstance(params, dict) or 'text' not in params or 'script' not in params:
+                    raise PreviewError('text and script are required')
+                body = service.preview(
+                    str(params['text']), params['script'], params.get('font'), _flag(params.get('png', False))
+                )
+            else:
+                status = 404
+                body = {'error': 'no such endpoint'}
+        except PreviewError as e:
+            status = 400
+            body = {'error': str(e)}
+        except Exception as e:
+            status = 500
+            body = {'error': '{}: {}'.format(type(e).__name__, e)}
+
+        elapsed = time.perf_counter() - start
+        if isinstance(body, dict) and endpoint == '/preview':
+            body['elapsed_ms'] = round(elapsed * 1000, 3)
+        self._elapsed = elapsed
+        self._reply(status, body, elapsed)
+        if status != 404:
+            service.record(endpoint, elapsed, error=status != 200)
+
+    def do_GET(self):
+        self._handle(None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            params = json.loads(self.rfile.read(length).decode('UTF-8'))
+        except ValueError:
+            params = []
+        self._handle(params)
+
+    def log_request(self, code='-', size='-'):
+        self.log_message('"%s" %s %.3fms', self.requestline, str(code), getattr(self, '_elapsed', 0) * 1000)
+
+
+def make_server(game, host='127.0.0.1', port=8000):
+    """Creates an HTTP server answering preview requests for a game. Call
+    serve_forever() on it to start serving."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.service = RenderService(game)
+
+    return server
+
+
+__all__ = ['Handler', 'Latencies', 'PreviewError', 'RenderService', 'make_server']
@@ -0,0 +1,267 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import sys
+
+import numpy as np
+
+# Tiles are hashed eight bytes at a time: each word is offset by a constant
+# for its position and put through the SplitMix64 finaliser, and the results
+# are summed.
+_OFFSETS = np.random.RandomState(0x5eed).randint(0, 1 << 62, 64, dtype=np.int64).astype(np.uint64)
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+
+# Tile ids are slots in a TileStore, with any flips of the tile in the top
+# bits: FLIP_H mirrors it left to right, FLIP_V top to bottom.
+FLIP_SHIFT = 28
+SLOT_MASK = (1 << FLIP_SHIFT) - 1
+FLIP_H = 1
+FLIP_V = 2
+
+
+def tile_digests(tiles):
+    """Returns a 64-bit digest of each tile in an (n, height, width) array."""
+    n = len(tiles)
+    size = tiles[0].size if n else 0
+    if size % 8 == 0:
+        words = np.ascontiguousarray(tiles, dtype=np.uint8).reshape(n, size)
+    else:
+        words = np.zeros((n, size + 8 - size % 8), dtype=np.uint8)
+        words[:, :size] = np.reshape(tiles, (n, size))
+    words = words.view(np.uint64)
+
+    words = words + np.resize(_OFFSETS, words.shape[1])
+    words ^= words >> np.uint64(30)
+    words *= _MIX1
+    words ^= words >> np.uint64(27)
+    words *= _MIX2
+    words ^= words >> np.uint64(31)
+
+    return words.sum(axis=1, dtype=np.uint64)
+
+
+def flip_tiles(tiles, flips):
+    """Returns an (n, height, width) array with each tile flipped by flips."""
+    tiles = tiles.copy()
+
+    for flip in (FLIP_H, FLIP_V, FLIP_H | FLIP_V):
+        which = flips == flip
+        if which.any():
+            flipped = tiles[which]
+            if flip & FLIP_H:
+                flipped = flipped[:, :, ::-1]
+            if flip & FLIP_V:
+                flipped = flipped[:, ::-1, :]
+            tiles[which] = flipped
+
+    return tiles
+
+
+def canonical_tiles(tiles):
+    """Picks one orientation of each tile of an (n, height, width) array.
+
+    Of a tile's four flips, the one with the lowest digest is canonical, so
+    tiles which are flips of one another have the same canonical tile.
+    Returns the canonical tiles, their digests, and the flips which turn
+    each canonical tile back into the original.
+    """
+    variants = np.stack([
+        tiles,
+        tiles[:, :, ::-1],
+        tiles[:, ::-1, :],
+        tiles[:, ::-1, ::-1],
+    ])
+    digests = np.stack([tile_digests(variant) for variant in variants])
+
+    # Flips are their own inverses, so the flip which made the canonical
+    # tile also undoes it. Ties go to the smallest flip.
+    flips = digests.argmin(axis=0)
+    which = np.arange(len(tiles))
+
+    return variants[flips, which], digests[flips, which], flips.astype(np.int32)
+
+
+def remap_ids(remap, ids, flips=None):
+    """Renumbers the slots of tile ids through remap, keeping their flips.
+
+    If flips is given, the flips of each id are combined with those of its
+    old slot, for when the tile in that slot has itself been flipped.
+    """
+    slots = ids & SLOT_MASK
+    if flips is None:
+        return remap[slots] | (ids & ~SLOT_MASK)
+
+    return remap[slots] | (((ids >> FLIP_SHIFT) ^ flips[slots]) << FLIP_SHIFT)
+
+
+class TileStore:
+    """A bank of unique tiles of one size, kept in a single contiguous buffer.
+
+    Tiles are found by a 64-bit digest of their pixels. Every lookup is
+    checked against the stored pixels, so two tiles with the same digest are
+    still told apart; the rare second tile is indexed by its bytes instead.
+    """
+
+    def __init__(self, height, width, capacity=256):
+        self._buffer = np.zeros((capacity, height, width), dtype=np.uint8)
+        self._count = 0
+        self._index = {}
+        self._collisions = {}
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        """Creates a store holding the tiles of an (n, height, width) array, in order.
+
+        The tiles must be unique, so that each keeps its slot.
+        """
+        store = cls(tiles.shape[1], tiles.shape[2], max(len(tiles), 1))
+        if len(store.add(tiles)) != len(store):
+            raise ValueError('tiles are not unique')
+
+        return store
+
+    def __len__(self):
+        return self._count
+
+    def __getstate__(self):
+        # Worker processes send their stores back to the parent; leave out the slack.
+        state = self.__dict__.copy()
+        state['_buffer'] = self.tiles.copy()
+        return state
+
+    @property
+    def shape(self):
+        """The (height, width) of the stored tiles."""
+        return self._buffer.shape[1:]
+
+    @property
+    def tiles(self):
+        """An (n, height, width) view of the stored tiles, in slot order."""
+        return self._buffer[:self._count]
+
+    @property
+    def nbytes(self):
+        """The approximate memory used by the store, in bytes."""
+        index = sys.getsizeof(self._index) + sys.getsizeof(self._collisions)
+        # Each entry also holds a key and a slot object of about 32 bytes each.
+        index += 64 * (len(self._index) + len(self._collisions))
+
+        return self._buffer.nbytes + index
+
+    def take(self, ids):
+        """Returns the tiles with the given ids as an (n, height, width) array."""
+        tiles = self.tiles[ids & SLOT_MASK]
+        flips = ids >> FLIP_SHIFT
+
+        if flips.any():
+            tiles = flip_tiles(tiles, flips)
+
+        return tiles
+
+    def _append(self, tile):
+        if self._count == len(self._buffer):
+            grown = np.zeros((max(2 * self._count, 1),) + self.shape, dtype=np.uint8)
+            grown[:self._count] = self._buffer[:self._count]
+            self._buffer = grown
+
+        self._buffer[self._count] = tile
+        self._count += 1
+        return self._count - 1
+
+    def _find(self, tile, digest):
+        slot = self._index.get(digest)
+        if slot is not None and np.array_equal(self._buffer[slot], tile):
+            return slot
+        if self._collisions:
+            return self._collisions.get(tile.tobytes())
+        return None
+
+    def _insert(self, tile, digest):
+        slot = self._append(tile)
+        if digest in self._index:
+            self._collisions[tile.tobytes()] = slot
+        else:
+            self._index[digest] = slot
+        return slot
+
+    def add(self, tiles, digests=None):
+        """Adds the tiles of an (n, height, width) array which are not yet stored.
+
+        New tiles are given slots in order of first occurrence. Returns the
+        slot of each tile as an int32 array. digests may be passed in if
+        they are already known.
+        """
+        if digests is None:
+            digests = tile_digests(tiles)
+
+        ids = np.empty(len(tiles), dtype=np.int32)
+        start = self._count
+        added = []
+        index = self._index
+
+        # Trust the digests, then check every tile at once.
+        for i, digest in enumerate(digests.tolist()):
+            slot = index.get(digest)
+            if slot is None and self._collisions:
+                slot = self._collisions.get(tiles[i].tobytes())
+            if slot is None:
+                slot = index[digest] = self._append(tiles[i])
+                added.append(digest)
+            ids[i] = slot
+
+        if (self._buffer[ids] == tiles).all():
+            return ids
+
+        # A digest matched the wrong tile; undo and check each tile in turn.
+        for digest in added:
+            del index[digest]
+        self._count = start
+
+        for i, digest in enumerate(digests.tolist()):
+            slot = self._find(tiles[i], digest)
+            ids[i] = self._insert(tiles[i], digest) if slot is None else slot
+
+        return ids
+
+    def lookup(self, tiles, digests=None):
+        """Returns the slot of each tile of an (n, height, width) array, or -1."""
+        if digests is None:
+            digests = tile_digests(tiles)
+
+        slots = np.empty(len(tiles), dtype=np.int32)
+        for i, digest in enumerate(digests.tolist()):
+            slot = self._find(tiles[i], digest)
+            slots[i] = -1 if slot is None else slot
+
+        return slots
+
+    def replace(self, slot, tile):
+        """Puts a tile which is not yet stored in the place of the tile in slot."""
+        old = self._buffer[slot]
+        digest = int(tile_digests(old[np.newaxis])[0])
+        if self._index.get(digest) == slot:
+            del self._index[digest]
+        else:
+            self._collisions.pop(old.tobytes(), None)
+
+        self._buffer[slot] = tile
+        digest = int(tile_digests(tile[np.newaxis])[0])
+        if digest in self._index:
+            self._collisions[tile.tobytes()] = slot
+        else:
+            self._index[digest] = slot
+
+
+__all__ = ['TileStore', 'canonical_tiles', 'flip_tiles', 'remap_ids', 'tile_digests']
@@ -0,0 +1,133 @@
+# Copyright 2018 Kiyoshi Aman
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR
+# IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import os
+import time
+
+
+def _stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class Watcher:
+    """Keeps a game loaded and renders its targets again as their inputs change.
+
+    game.json and the scripts and fonts it names are polled for changes to
+    their modification time or size. Only the targets a changed file affects
+    are rendered again, with the game's fonts, line cache and build cache
+    kept warm in between.
+    """
+
+    def __init__(self, game, render_path, interval=0.25):
+        self._game = game
+        self._render_path = render_path
+        self._interval = interval
+        self._stamps = self._poll()
+
+    @property
+    def game(self):
+        return self._game
+
+    def _files(self):
+        files = {os.path.abspath(self._game.filename): self._game.filename}
+        for target in self._game.targets:
+            for filename in self._game.inputs(target):
+                files.setdefault(os.path.abspath(filename), filename)
+
+        return files
+
+    def _poll(self):
+        return {path: _stamp(filename) for path, filename in self._files().items()}
+
+    def changes(self):
+        """Returns the files which have changed since the last call, once they
+        have stopped changing. Files which are missing, as while an editor is
+        replacing them, are not reported until they are back."""
+        stamps = self._poll()
+        if stamps == self._stamps:
+            return []
+
+        while True:
+            time.sleep(self._interval / 2)
+            settled = self._poll()
+            if settled == stamps:
+                break
+            stamps = settled
+
+        changed = [path for path, stamp in stamps.items()
+                   if stamp is not None and stamp != self._stamps.get(path)]
+        for path in changed:
+            self._stamps[path] = stamps[path]
+
+        return changed
+
+    def update(self, changed):
+        """Reloads the changed files and renders the targets they affect.
+        Returns those targets."""
+        game_file = os.path.abspath(self._game.filename)
+        targets = set()
+
+        # Fonts go first, so that reloading game.json does not keep a stale one.
+        for path in sorted(changed, key=lambda path: path == game_file):
+            if path == game_file:
+                self._game.reload()
+                targets.update(self._game.targets)
+            else:
+                targets.update(self._game.reload_file(path))
+
+        # game.json may have added files to watch.
+        for path, stamp in self._poll().items():
+            self._stamps.setdefault(path, stamp)
+
+        targets = [target for target in self._game.targets if target in targets]
+        for target in targets:
+            print('Processing {}...'.format(target))
+            self._game.render(target, self._render_path, output=True)
+            print('{} processed.'.format(target))
+
+        return targets
+
+    def run(self):
+        """Watches for changes until interrupted. Errors, such as a script
+        using a character its font lacks, are reported without stopping."""
+        print('Watching {} files for changes; press Ctrl-C to stop.'.format(len(self._stamps)))
+
+        try:
+            while True:
+                time.sleep(self._interval)
+                changed = self.changes()
+                if not changed:
+                    continue
+
+                for path in changed:
+                    print('Changed: {}'.format(os.path.relpath(path)))
+
+                start = time.perf_counter()
+                try:
+                    targets = self.update(changed)
+                except Exception as e:
+                    print('ERROR: {}: {}'.format(type(e).__name__, e))
+                    continue
+
+                if targets:
+                    print('Rebuilt {} target(s) in {:.3f}s.'.format(len(targets), time.perf_counter() - start))
+        except KeyboardInterrupt:
+            print('Stopped watching.')
+
+
+__all__ = ['Watcher']